@@ -41,95 +41,320 @@ import os
 import sys
 import signal
 import glob
+import tempfile
+import fcntl
 import subprocess
 import socket
 import time
 import logging
 import argparse
 import json
-from   PyQt4 import QtCore
-from multiprocessing import Process, Queue
-from numpy import (array, dot)
-from numpy.linalg import norm
+import threading
+import Queue
+import re
+import struct
+import errno
+import shutil
+import select
+import shlex
+from   contextlib import contextmanager
+from   collections import deque, namedtuple
+# PyQt4 and NumPy are imported where they are used, so that the client
+# commands, which only send a command to the daemon, start quickly.
 
 
 SPIN_SOCKET = '/tmp/yoga_spin.socket'
+ACPI_SOCKET = '/var/run/acpid.socket'
 SETTINGS = '{home}/.config/spin/spin.conf'.format(home = os.environ['HOME'])
+DEVICE_SETTINGS = '{home}/.config/spin/devices.conf'.format(home = os.environ['HOME'])
+ACPI_SETTINGS = '{home}/.config/spin/acpi.conf'.format(home = os.environ['HOME'])
+IIO_DEVICES = '/sys/bus/iio/devices'
+IIO_CHARDEVS = '/dev'
+ORIENTATIONS = ["normal", "right", "inverted", "left"]
+# The commands the daemon accepts on its control socket, besides "status".
+MODES = ["toggle", "tablet", "laptop"] + ORIENTATIONS + ["togglelock", "toggletouch", "calibrate"]
+# Version of the JSON-lines control protocol spoken on SPIN_SOCKET.
+PROTOCOL_VERSION = 1
+# Version of the input capture files written by --record.
+CAPTURE_VERSION = 1
+# The sources of trace records, and the values of those other than samples.
+TRACE_SOURCES = ["accel", "stylus", "command", "candidate", "orientation", "engage"]
+TRACE_VALUES = [None, "in", "out", "flat"] + MODES
+TRACE_RECORD = struct.Struct("<dB3f")
+# Events of these kinds only matter by their latest value, so a subscriber
+# that falls behind gets the latest one instead of every one in between.
+COALESCED_EVENTS = ["mode", "orientation", "locked", "touchy", "stylus", "candidate"]
+# Unit gravity vectors, one per entry of ORIENTATIONS.
+ORIENTATION_VECTORS = (
+    ( 0.0, -1.0, 0.0),
+    (-1.0,  0.0, 0.0),
+    ( 0.0,  1.0, 0.0),
+    ( 1.0,  0.0, 0.0)
+)
+DEVICE_KEYPHRASES = {
+    "touchscreen": ["SYNAPTICS Synaptics Touch Digitizer V04",
+                    "ELAN Touchscreen",
+                    "Wacom Co.,Ltd. Pen and multitouch sensor Finger touch"],
+    "touchpad":    ["PS/2 Synaptics TouchPad",
+                    "SynPS/2 Synaptics TouchPad",
+                    "ETPS/2 Elantech Touchpad"],
+    "nipple":      ["TPPS/2 IBM TrackPoint",
+                    "ETPS/2 Elantech TrackPoint"],
+    "stylus":      ["Wacom ISDv4 EC Pen stylus",
+                    "Wacom Co.,Ltd. Pen and multitouch sensor Pen stylus"],
+    "eraser":      ["Wacom ISDv4 EC Pen eraser",
+                    "Wacom Co.,Ltd. Pen and multitouch sensor Pen eraser"]
+}
+# ACPI event (class, device, code, value) to daemon mode and the number of
+# seconds during which a repeat of the event is ignored.
+ACPI_ACTIONS = {
+    # The rotation lock key triggers acpi twice.
+    ("ibm/hotkey", "LEN0068:00", "00000080", "00006020"): ("togglelock", 0.5),
+    ("ibm/hotkey", "LEN0068:00", "00000080", "000060c0"): ("toggle", 0.0),
+    # Even though the tablet mode event toggles twice, in the end it works out.
+    ("", "PNP0C14:04", "000000b0", "00000000"): ("toggle", 0.0)
+}
+# An output line of xrandr -q, such as
+# "eDP1 connected primary 1920x1080+0+0 left (normal left inverted right x axis y axis) 277mm x 156mm"
+XRANDR_OUTPUT = re.compile(r"^(\S+) (connected|disconnected)( primary)?"
+                           r"(?: (\d+)x(\d+)\+(-?\d+)\+(-?\d+))?(?: (normal|left|inverted|right))?")
+# Name prefixes of the outputs of built-in screens.
+INTERNAL_OUTPUTS = ["eDP", "LVDS", "DSI"]
+# Rotations of an absolute input device within its unit square, as
+# coordinate transformation matrices in row order.
+TOUCHSCREEN_MATRICES = {
+    "left":     ( 0, -1, 1,  1,  0, 0, 0, 0, 1),
+    "right":    ( 0,  1, 0, -1,  0, 1, 0, 0, 1),
+    "inverted": (-1,  0, 1,  0, -1, 1, 0, 0, 1),
+    "normal":   ( 1,  0, 0,  0,  1, 0, 0, 0, 1)
+}
+
+
+class CalibrationStore():
+    '''
+    The Wacom calibration of every device, output and orientation, kept in memory.
+
+    The settings file holds {"version": 2, "calibrations": {device: {output:
+    {orientation: [minx, miny, maxx, maxy]}}}}, where the output "*" stands
+    for every output without a calibration of its own. A device without any
+    calibration shares the one of device, the stylus, so its eraser follows
+    it. Files in the old format, holding the four orientations of a single
+    stylus, are migrated when loaded.
+
+    The file is read in one go, and only read again when its modification
+    time changes. Changes are written delay seconds after the first of them,
+    so a burst of changes costs one write, to a temporary file that then
+    replaces the settings, so a crash never leaves half a file behind. A
+    file that cannot be read is never written over, so a mistake made when
+    editing it by hand costs no calibrations; changes are then only kept in
+    memory until it is fixed. The backend arguments of each area are prepared once, so applying a
+    calibration costs only the final property write.
+    '''
+
+    def __init__(self, device, backend, path = SETTINGS, delay = 0.0):
+        self.device = device
+        self.backend = backend
+        self.path = path
+        self.delay = delay
+        self.lock = threading.RLock()
+        self.mtime = None
+        self.calibrations = None
+        self.prepared = {}
+        self.dirty = False
+        self.timer = None
+        self.unreadable = False
+
+    def load(self):
+        ''' Load the calibrations from disk, and return them by (device, output, orientation) '''
+        with self.lock:
+            data = {}
+            mtime = None
+            unreadable = False
+            if os.path.exists(self.path):
+                try:
+                    mtime = os.stat(self.path).st_mtime
+                    with open(self.path) as settings:
+                        data = json.load(settings)
+                    if not isinstance(data, dict):
+                        raise ValueError("The settings are not a JSON object")
+                except (IOError, OSError, ValueError) as err:
+                    log.error("Ignoring the calibration in {path}: {err}".format(path = self.path, err = err))
+                    data = {}
+                    unreadable = True
+            self.calibrations = {}
+            self.prepared = {}
+            self.mtime = mtime
+            self.unreadable = unreadable
+            migrate = data and "calibrations" not in data
+            if migrate:
+                log.info("Migrating the calibration in {0}".format(self.path))
+                data = {"calibrations": {self.device: {"*": data}}}
+            for device, outputs in data.get("calibrations", {}).iteritems():
+                for output, orientations in outputs.iteritems():
+                    for orientation, area in orientations.iteritems():
+                        if orientation in ORIENTATIONS and isinstance(area, list) and len(area) == 4:
+                            self.calibrations[(device, output, orientation)] = [int(value) for value in area]
+                        else:
+                            log.error("Ignoring the calibration {area} of {device} for \"{orientation}\"".format(
+                                area        = area,
+                                device      = device,
+                                orientation = orientation
+                            ))
+            if migrate:
+                self.save()
+            return self.calibrations
+
+    def changed(self):
+        ''' Return whether the file changed since it was last loaded or saved '''
+        try:
+            return os.stat(self.path).st_mtime != self.mtime
+        except OSError:
+            return True
+
+    def area(self, orientation, device = None, output = "*"):
+        ''' Return the calibration of device, by default the stylus, on output in orientation '''
+        if device is None:
+            device = self.device
+        with self.lock:
+            if self.calibrations is None or (not self.dirty and self.changed()):
+                self.load()
+            for key in [(device, output, orientation), (device, "*", orientation),
+                        (self.device, output, orientation), (self.device, "*", orientation)]:
+                if key in self.calibrations:
+                    return list(self.calibrations[key])
+            # Nothing is calibrated yet, so start from the current area.
+            area = self.backend.get_area(device)
+            for each in ORIENTATIONS:
+                self.calibrations[(device, "*", each)] = list(area)
+            self.save()
+            return list(area)
+
+    def prepared_area(self, orientation, device = None, output = "*"):
+        ''' Return the area() of device, as prepared for backend.apply_area() '''
+        key = (device, output, orientation)
+        with self.lock:
+            if self.calibrations is None or (not self.dirty and self.changed()):
+                self.load()
+            if key not in self.prepared:
+                self.prepared[key] = self.backend.prepare_area(
+                    device if device is not None else self.device,
+                    self.area(orientation, device, output)
+                )
+            return self.prepared[key]
+
+    def set(self, area, orientation, device = None, output = "*"):
+        ''' Change the calibration of device on output in orientation, and save it '''
+        if device is None:
+            device = self.device
+        with self.lock:
+            if self.calibrations is None:
+                self.load()
+            self.calibrations[(device, output, orientation)] = [int(value) for value in area]
+            self.prepared = {}
+            self.save()
+
+    def save(self):
+        ''' Write the calibrations to disk delay seconds from now, along with later changes '''
+        with self.lock:
+            self.dirty = True
+            if self.delay <= 0:
+                self.flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        ''' Write pending changes to disk now '''
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.dirty:
+                return
+            if self.unreadable:
+                log.error("Keeping the calibration in memory rather than writing over {0}, "
+                          "which could not be read".format(self.path))
+                self.dirty = False
+                return
+            data = {}
+            for (device, output, orientation), area in self.calibrations.iteritems():
+                data.setdefault(device, {}).setdefault(output, {})[orientation] = area
+            json_data = json.dumps({"version": 2, "calibrations": data},
+                                   sort_keys=True,
+                                   indent=4,
+                                   separators=(',', ': '))
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, temporary = tempfile.mkstemp(prefix = ".spin.conf.", dir = directory)
+            try:
+                with os.fdopen(fd, "w") as settings:
+                    settings.write(json_data)
+                    settings.flush()
+                    os.fsync(settings.fileno())
+                os.rename(temporary, self.path)
+            except (IOError, OSError) as err:
+                log.error("Failed to save the calibration to {path}: {err}".format(path = self.path, err = err))
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                return
+            self.mtime = os.stat(self.path).st_mtime
+            self.dirty = False
 
 
 class Calibration():
 
-    def __init__(self, device):
+    def __init__(self, device, backend = None, orientation = None, store = None, output = None):
         ''' Load current settings into memory '''
         self.device = device
-        self.orientation = self.get_orientation()
-        if not os.path.exists(SETTINGS):
-            cal = self.get_calibration()
-            self.calibration = {
-                "normal": [cal[0], cal[1], cal[2], cal[3]],
-                "inverted": [cal[0], cal[1], cal[2], cal[3]],
-                "left": [cal[0], cal[1], cal[2], cal[3]],
-                "right": [cal[0], cal[1], cal[2], cal[3]]
-            }
-            self.save_calibration()
-        else:
-            self.load_calibration()
-
-    def get_orientation(self):
-        ''' Return the current screen orientation '''
-        xrandr = subprocess.Popen(['xrandr', '-q', '--verbose'], stdout=subprocess.PIPE)
-        for line in xrandr.stdout:
-            if "eDP1" in line:
-                orientation = line.split()[5]
-                if '(' in orientation:
-                    return('normal')
-                else:
-                    return(orientation)
-        print('Warning! Unable to detect screen orientation.')
-        return('normal')
+        if backend is None:
+            backend = CommandBackend()
+        self.backend = backend
+        if orientation is None or output is None:
+            outputs = OutputCache(backend)
+            outputs.refresh()
+            if orientation is None:
+                orientation = self.get_orientation(outputs)
+            if output is None:
+                output = outputs.internal() or "*"
+        self.orientation = orientation
+        self.output = output
+        if store is None:
+            store = CalibrationStore(device, backend)
+        self.store = store
+        self.load_calibration()
+
+    def get_orientation(self, outputs):
+        ''' Return the current orientation of the built-in screen '''
+        orientation = outputs.orientation()
+        if orientation is None:
+            print('Warning! Unable to detect screen orientation.')
+            return('normal')
+        return orientation
 
     def get_calibration(self):
         ''' Return the current calibration values '''
-        current_area = subprocess.check_output(
-            ['xsetwacom',
-             '--get',
-             '{device}'.format(device = self.device),
-             'Area'])
-        return current_area.split()
+        return self.backend.get_area(self.device)
         
 
     def save_calibration(self):
-        """ Write the calibration to disk """
-        try:
-            if not os.path.isdir(os.path.dirname(SETTINGS)):
-                os.makedirs(os.path.dirname(SETTINGS))
-        except Exception, err:
-            print(err)
-        json_data = json.dumps(self.calibration,
-                               sort_keys=True,
-                               indent=4,
-                               separators=(',', ': '))
-        f = open(SETTINGS, "w")
-        f.write(json_data)
-        f.close()
+        """ Write the calibration of the current orientation to disk """
+        self.store.set(self.calibration[self.orientation], self.orientation, self.device, self.output)
+        self.store.flush()
 
     def load_calibration(self):
-        ''' Load calibration for current screen orientation from disk '''
-        with open(SETTINGS) as cal:
-            self.calibration = json.load(cal)
+        ''' Load the calibration of every screen orientation from disk '''
+        self.calibration = dict((orientation, self.store.area(orientation, self.device, self.output))
+                                for orientation in ORIENTATIONS)
 
 
     def set_calibration(self):
         ''' Set the calibration for the current orientation '''
-        xsetwacom_command = 'xsetwacom --set "{device}" Area {minx} {miny} {maxx} {maxy}'.format(device=self.device,
-                                                                                                 minx=self.calibration[self.orientation][0],
-                                                                                                 miny=self.calibration[self.orientation][1],
-                                                                                                 maxx=self.calibration[self.orientation][2],
-                                                                                                 maxy=self.calibration[self.orientation][3])
-        log.info('Wacom stylus calibration set to {area} for "{orientation}" screen orientation'.format(area=self.calibration[self.orientation],
+        area = self.calibration[self.orientation]
+        log.info('Wacom stylus calibration set to {area} for "{orientation}" screen orientation'.format(area=area,
                                                                                                          orientation=self.orientation))
-        log.debug('Ran {cmd}'.format(cmd=xsetwacom_command))
-        os.system(xsetwacom_command)
+        self.backend.set_area(self.device, area)
             
     def reset_calibration(self):
         ''' Reset the calibration for the current screen orientation '''
@@ -168,527 +393,3121 @@ class Calibration():
         #    cal[2] = normal_cal[3]
         #    cal[3] = normal_cal[2]
         print('New calibration: {new}'.format(new=cal))
-        print('Calibration saved to {settings}'.format(settings=SETTINGS))
+        print('Calibration saved to {settings}'.format(settings=self.store.path))
         self.calibration[self.orientation] = cal
         self.set_calibration()
         self.save_calibration()
 
 
 
-class Daemon(QtCore.QObject):
+class Daemon(object):
 
-    def __init__(self):
+    def __init__(self, hysteresis = 10.0, dwell = 0.3, backend = None,
+                 acpi_socket = ACPI_SOCKET, acpi_actions = None, spin_socket = SPIN_SOCKET,
+                 settings = SETTINGS, iio_root = IIO_DEVICES, iio_chardevs = IIO_CHARDEVS,
+                 sense_stylus = True, mounting = None, flat = 25.0, palm_grace = 0.5):
         super(Daemon, self).__init__()
-        # Capture SIGINT
-        signal.signal(signal.SIGINT, self.signal_handler)
+        started = time.time()
+        self.spin_socket_path = spin_socket
+        self.hysteresis = hysteresis
+        self.dwell = dwell
+        self.mounting = mounting
+        self.flat = flat
+        self.acpi_socket_path = acpi_socket
+        self.iio_root = iio_root
+        self.iio_chardevs = iio_chardevs
+        self.sense_stylus = sense_stylus
+        if acpi_actions is None:
+            acpi_actions = load_acpi_actions()
+        self.acpi_actions = acpi_actions
+        if backend is None:
+            backend = open_backend()
+        self.backend = backend
+        # Every input is watched by its file descriptor, so the event loop
+        # only wakes up when there is something to handle.
+        self.notifiers = {}
+        self.wakeups = 0
+        # Capture SIGINT, SIGUSR1 and SIGUSR2. The handlers only note the
+        # signal, which is acted upon when it wakes up the event loop, as the
+        # locks the actions take may be held by the interrupted code.
+        self.signals = deque()
+        for signum in [signal.SIGINT, signal.SIGUSR1, signal.SIGUSR2]:
+            signal.signal(signum, self.signal_handler)
+        self.signal_pipe = os.pipe()
+        for fd in self.signal_pipe:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self.signal_pipe[1])
+        self.watch(self.signal_pipe[0], self.signal_listen)
         # Check if spin is running.
-        if os.path.exists(SPIN_SOCKET):
-            os.remove(SPIN_SOCKET)
-        # Audit the inputs available.
-        self.device_names = get_inputs()
+        if os.path.exists(self.spin_socket_path):
+            os.remove(self.spin_socket_path)
+        # Audit the inputs available, and keep track of them.
+        log.info("Audit Inputs:")
+        self.registry = DeviceRegistry(self.backend)
+        self.registry.refresh()
+        for role in sorted(self.registry.keyphrases):
+            if not self.registry.devices(role):
+                log.info(" - {role} not detected".format(role = role.title()))
+        self.registry.watch()
         log.debug("Device names: {device_names}".format(device_names = self.device_names))
-        # Set default laptop mode
+        self.calibration_store = CalibrationStore(self.device_names.get("stylus"), self.backend, settings, delay = 1.0)
+        # The sensors run in threads that post to one bounded event channel.
+        self.sensor_channel = EventChannel()
+        self.watch(self.sensor_channel.fileno(), self.sensor_listen)
+        # Keep track of the screen rotation, including rotations made by others.
+        log.info("Audit Outputs:")
+        self.transforms = InputTransforms()
+        self.mapped_layout = None
+        self.outputs = OutputCache(self.backend, on_change = lambda: self.sensor_channel.put("outputs", None))
+        self.outputs.refresh()
+        self.outputs.watch()
+        # Set default laptop mode, in the current screen orientation
         self.mode = "laptop"
-        self.orientation = "normal"
+        self.orientation = self.outputs.orientation() or "normal"
         self.locked = True
         self.touchy = True
+        # Turn touch off as soon as the pen comes near, without queueing
+        self.palm_rejection = PalmRejection(lambda enabled: self.device_switch("touchscreen", enabled),
+                                            grace = palm_grace)
+        # Run the X actions of mode changes in order, off the event loop
+        self.action_worker = ActionWorker()
+        self.action_worker.start()
+        # Run the independent steps of a transition at the same time
+        self.executor = ActionExecutor()
+        self.i3_msg = find_command("i3-msg")
+        self.reconciler = StateReconciler(
+            self.action_worker,
+            self.transition,
+            self.executor,
+            mode        = self.mode,
+            orientation = self.orientation,
+            locked      = self.locked,
+            touchy      = self.touchy
+        )
         # Engage stylus proximity control
         self.stylus_proximity_switch(status = True)
-        # Start a queue for reading screen rotation from the accelerometer
-        self.accelerometer_queue = Queue()
-        self.accelerometer_timer = QtCore.QTimer()
-        self.accelerometer_timer.timeout.connect(self.accelerometer_listen)
-        self.accelerometer_timer.start(100)
-        self.accelerometer_switch(status = True)
+        # Read screen rotation from the accelerometer, while it is unlocked
+        self.accelerometer_sync()
         # Listen for commands through a socket
-        if os.path.exists(SPIN_SOCKET):
-            os.remove(SPIN_SOCKET)
-        self.spin_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        self.spin_socket.setblocking(0)
-        self.spin_socket.bind(SPIN_SOCKET)
-        self.spin_timer = QtCore.QTimer()
-        self.spin_timer.timeout.connect(self.socket_listen)
-        self.spin_timer.start(105)
+        self.control_server = ControlServer(self.spin_socket_path, self.watch, self.unwatch, self.control)
         # Listen for ACPI events
-        self.acpi_queue = Queue()
-        self.acpi_timer = QtCore.QTimer()
-        self.acpi_timer.timeout.connect(self.acpi_listen)
-        self.acpi_timer.start(110)
         self.acpi_switch(True)
+        log.info("Daemon started in {elapsed:.3f} s, using {rss} kB of memory".format(
+            elapsed = time.time() - started,
+            rss     = resident_memory()
+        ))
+
+
+    def watch(self, fd, callback, write = False):
+        ''' Call callback from the event loop whenever fd becomes readable, or writable '''
+        from PyQt4 import QtCore
+        if write:
+            notifier = QtCore.QSocketNotifier(fd, QtCore.QSocketNotifier.Write)
+        else:
+            notifier = QtCore.QSocketNotifier(fd, QtCore.QSocketNotifier.Read)
+        def activated(fd):
+            self.wakeups += 1
+            callback()
+        notifier.activated.connect(activated)
+        self.notifiers[(fd, write)] = notifier
 
 
-    def signal_handler(self, signal, frame):
-        log.info('You pressed Ctrl-C!')
-        self.close_event('bla')
-        sys.exit(0)
+    def unwatch(self, fd, write = False):
+        notifier = self.notifiers.pop((fd, write), None)
+        if notifier is not None:
+            notifier.setEnabled(False)
+
+
+    def signal_listen(self):
+        ''' Drain the signal wakeup pipe, and act on the signals the handler noted '''
+        try:
+            while os.read(self.signal_pipe[0], 64):
+                pass
+        except OSError:
+            pass
+        while self.signals:
+            signum = self.signals.popleft()
+            if signum == signal.SIGUSR1:
+                self.latency_dump()
+            elif signum == signal.SIGUSR2:
+                trace.dump()
+            elif signum == signal.SIGINT:
+                log.info('You pressed Ctrl-C!')
+                self.close_event('bla')
+                from PyQt4 import QtCore
+                QtCore.QCoreApplication.instance().quit()
+                return
+
+
+    def signal_handler(self, signum, frame):
+        self.signals.append(signum)
+
+
+    def latency_dump(self):
+        ''' Print the stage timings as JSON, on SIGUSR1 '''
+        print(json.dumps(latency.summary(), indent = 4, sort_keys = True))
+        sys.stdout.flush()
 
 
     def close_event(self, event):
         log.info("Terminating Yoga Spin Daemon")
         if self.mode == "tablet":
             self.engage_mode("laptop")
+        self.action_worker.stop()
+        self.executor.stop()
         self.stylus_proximity_switch(status = False)
+        self.palm_rejection.stop()
         self.accelerometer_switch(status = False)
+        self.unwatch(self.sensor_channel.fileno())
+        self.sensor_channel.close()
         self.acpi_switch(status = False)
-        try:
-            os.remove(SPIN_SOCKET)
-        except:
-            pass
-
+        self.control_server.shutdown()
+        self.calibration_store.flush()
+        recorder.close()
+        # Leave no notifier on a file descriptor number that may be reused.
+        for fd, write in list(self.notifiers):
+            self.unwatch(fd, write)
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for signum in [signal.SIGUSR1, signal.SIGUSR2]:
+            signal.signal(signum, signal.SIG_DFL)
+        for fd in self.signal_pipe:
+            os.close(fd)
+
+
+    @property
+    def device_names(self):
+        return self.registry.names()
 
     def display_orientation(self, orientation = None):
         if orientation in ["left", "right", "inverted", "normal"]:
-            log.info("Orienting display to {0}".format(orientation))
-            engage_command("xrandr -o {0}".format(orientation))
+            log.info("Orienting display to %s", orientation)
+            self.backend.rotate(orientation)
         else:
             log.error("Unknown display orientation \"{0}\" requested".format(orientation))
             sys.exit()
 
     def touchscreen_orientation(self, orientation = None):
         if "touchscreen" in self.device_names:
-            coordinate_matrix = {
-                "left":     "0 -1 1 1 0 0 0 0 1",
-                "right":    "0 1 0 -1 0 1 0 0 1",
-                "inverted": "-1 0 1 0 -1 1 0 0 1",
-                "normal":   "1 0 0 0 1 0 0 0 1"
-            }
             # Waiting for the touchscreen to reconnect, after the screen rotates.
-            while not self.is_touchscreen_alive():
-                time.sleep(0.5)
-            if coordinate_matrix.has_key(orientation):
-                log.info("Orienting touchscreen to {0}".format(orientation))
-                engage_command(
-                    "xinput set-prop \"{device_name}\" \"Coordinate Transformation Matrix\" {matrix}".format(
-                        device_name = self.device_names["touchscreen"],
-                        matrix = coordinate_matrix[orientation]
-                    )
-                )
-            else:
-                log.error("Unknown touchscreen orientation \"{0}\" requested".format(orientation))
-                sys.exit()
+            with latency.span("touchscreen wait"):
+                alive = wait_for(self.is_touchscreen_alive)
+            if not alive:
+                log.error("The touchscreen did not respond")
+                return
+        if orientation in TOUCHSCREEN_MATRICES:
+            # The notification of the rotation may still be on its way.
+            self.outputs.refresh()
+            self.map_inputs(orientation = orientation)
         else:
-            log.debug("Touchscreen orientation unchanged")
+            log.error("Unknown touchscreen orientation \"{0}\" requested".format(orientation))
+            sys.exit()
+
+    def map_inputs(self, orientation = None):
+        '''
+        Map the touchscreens and pens onto the built-in screen, in orientation
+        or the current one. Touchscreens are rotated along with the screen,
+        while the Wacom driver rotates the pens itself.
+        '''
+        if orientation is None:
+            orientation = self.orientation
+        layout = self.outputs.layout()
+        output = self.outputs.internal()
+        geometry = self.outputs.geometry(output)
+        screen = self.outputs.screen()
+        if geometry is None or screen is None:
+            geometry, screen = (0, 0, 1, 1), (1, 1)
+        touchscreens = self.registry.devices("touchscreen")
+        if touchscreens:
+            log.info("Orienting touchscreen to %s on output %s", orientation, output)
+        with self.backend.batch():
+            if touchscreens:
+                matrix = self.transforms.matrix(orientation, geometry, screen)
+                for device in touchscreens:
+                    self.backend.set_matrix(device, matrix)
+            else:
+                log.debug("Touchscreen orientation unchanged")
+            matrix = self.transforms.matrix(None, geometry, screen)
+            for device in self.registry.devices("stylus") + self.registry.devices("eraser"):
+                self.backend.set_matrix(device, matrix)
+        self.mapped_layout = layout
 
     def touchscreen_switch(self, status = None):
         if "touchscreen" in self.device_names:
-            xinput_status = {
-                True:  "enable",
-                False: "disable"
-            }
-            while not self.is_touchscreen_alive():
-                time.sleep(0.5)
-            if xinput_status.has_key(status):
-                log.info("{status} touchscreen".format(
-                    status = xinput_status[status].title()
-                ))
-                engage_command(
-                    "xinput {status} \"{device_name}\"".format(
-                        status = xinput_status[status],
-                        device_name = self.device_names["touchscreen"]
-                    )
-                )
-            else:
-                log.error("Unknown touchscreen status \"{0}\" requested".format(status))
-                sys.exit()
+            with latency.span("touchscreen wait"):
+                alive = wait_for(self.is_touchscreen_alive)
+            if not alive:
+                log.error("The touchscreen did not respond")
+                return
+            with latency.span("touchscreen switch"):
+                self.device_switch("touchscreen", status)
         else:
             log.debug("Touchscreen status unchanged")
 
     
     def touchpad_switch(self, status = None):
         if "touchpad" in self.device_names:
-            xinput_status = {
-                True:  "enable",
-                False: "disable"
-            }
-            if xinput_status.has_key(status):
-                log.info("{status} touchpad".format(
-                    status = xinput_status[status].title()
-                ))
-                engage_command(
-                    "xinput {status} \"{device_name}\"".format(
-                        status = xinput_status[status],
-                        device_name = self.device_names["touchpad"]
-                    )
-                )
-            else:
-                log.error("Unknown touchpad status \"{0}\" requested".format(status))
-                sys.exit()
+            self.device_switch("touchpad", status)
         else:
             log.debug("Touchpad status unchanged")
 
 
     def nipple_switch(self, status = None):
         if "nipple" in self.device_names:
-            xinput_status = {
-                True:  "enable",
-                False: "disable"
-            }
-            if xinput_status.has_key(status):
-                log.info("{status} nipple".format(
-                    status = xinput_status[status].title()
-                ))
-                engage_command(
-                    "xinput {status} \"{device_name}\"".format(
-                        status = xinput_status[status],
-                        device_name = self.device_names["nipple"]
-                    )
-                )
-            else:
-                log.error("Unknown nipple status \"{0}\" requested".format(status))
-                sys.exit()
+            self.device_switch("nipple", status)
         else:
             log.debug("Nipple status unchanged")
 
 
-    def stylus_proximity(self):
-        self.previous_stylus_proximity = None
-        while True:
-            stylus_proximity_command = "xinput query-state " + \
-                                     "\""+self.device_names["stylus"]+"\" | " + \
-                                     "grep Proximity | cut -d \" \" -f3 | " + \
-                                     " cut -d \"=\" -f2"
-            self.stylus_proximity = subprocess.check_output(
-                stylus_proximity_command,
-                shell = True
-            ).lower().rstrip()
-            if  self.stylus_proximity == "out" and \
-                self.previous_stylus_proximity != "out":
-                log.info("Stylus inactive")
-                if self.touchy:
-                    self.touchscreen_switch(status = True)
-            elif self.stylus_proximity == "in" and \
-                self.previous_stylus_proximity != "in":
-                log.info("Stylus active")
-                self.touchscreen_switch(status = False)
-            self.previous_stylus_proximity = self.stylus_proximity
-            time.sleep(0.15)
+    def pointer_switch(self, status = None):
+        ''' Switch the touchpad and nipple in one batch '''
+        with latency.span("pointer switch"), self.backend.batch():
+            self.touchpad_switch(status = status)
+            self.nipple_switch(status = status)
+
+
+    def device_switch(self, device, status = None):
+        xinput_status = {
+            True:  "enable",
+            False: "disable"
+        }
+        if status in xinput_status:
+            log.info("%s %s", xinput_status[status].title(), device)
+            for device_name in self.registry.devices(device):
+                self.backend.set_enabled(device_name, status)
+        else:
+            log.error("Unknown {device} status \"{status}\" requested".format(
+                device = device,
+                status = status
+            ))
+            sys.exit()
+
+
+    def stylus_proximity(self, proximity = None, requested = None):
+        if proximity == "out":
+            log.info("Stylus inactive")
+        elif proximity == "in":
+            log.info("Stylus active")
+        else:
+            log.error("Unknown stylus proximity \"{0}\" reported".format(proximity))
+            return
+        self.palm_rejection.pen(proximity, requested)
 
 
     def stylus_proximity_switch(self, status = None):
         if status == True:
+            if "stylus" not in self.device_names:
+                log.info("No stylus to sense the proximity of")
+                return
+            if not self.sense_stylus:
+                log.debug("Stylus proximity is posted by someone else")
+                return
             log.info("Enabling stylus proximity sensor")
-            self.stylus_proximity_process = Process(
-                target = self.stylus_proximity
-            )
-            self.stylus_proximity_process.start()
+            self.stylus_sensor = StylusSensor(self.device_names["stylus"], self.sensor_channel)
+            self.stylus_sensor.start()
         elif status == False:
             log.info("Disabling stylus proximity sensor")
-            self.stylus_proximity_process.terminate()
+            if getattr(self, "stylus_sensor", None) is not None:
+                self.stylus_sensor.stop()
+                self.stylus_sensor = None
         else:
             log.error("Unknown stylus proximity control status \"{0}\" requested".format(status))
             sys.exit()
 
 
     def acpi_listen(self):
-        if self.acpi_queue.empty():
+        try:
+            data = self.acpi_socket.recv(4096)
+        except socket.error as err:
+            log.error("Failed to read ACPI event: {0}".format(err))
             return
-        mode = self.acpi_queue.get()
-        if mode == "togglelock":
-            self.acpi_queue.get()  # The rotation lock key triggers acpi twice, ignoring the second one.
-            self.engage_mode('togglelock')
-        elif mode == "display_position_change":
-            self.engage_mode("toggle")
-            log.info("Display mode changed")
-        elif mode == "tablet_mode_change":
-            # Even though the event toggles twice, in the end it works out
-            self.engage_mode("toggle")
-            log.info("Tablet mode changed")
-        else:
-            log.error("Triggered acpi_listen with unknown mode {0}".format(mode))
+        if not data:
+            log.error("The ACPI event socket was closed")
+            self.acpi_switch(status = False)
+            return
+        recorder.record("acpi", data)
+        for event in self.acpi_parser.feed(data):
+            self.acpi_dispatch(event)
 
 
-    def socket_listen(self):
-        try:
-            command = self.spin_socket.recv(1024)
-            if command:
-                self.engage_mode(command)
-        except:
-            # TODO! Output debug info
-            pass
+    def acpi_dispatch(self, event, received = None):
+        ''' Engage the mode of an ACPI event, unless it repeats a recent one '''
+        if received is None:
+            received = time.time()
+        if event not in self.acpi_actions:
+            log.info("Unknown acpi event triggered: %s", " ".join(event))
+            return
+        mode, repeat = self.acpi_actions[event]
+        last = self.acpi_last.get(event)
+        if last is not None and received - last < repeat:
+            log.debug("Ignoring repeated acpi event: %s", " ".join(event))
+            return
+        self.acpi_last[event] = received
+        log.info("ACPI event %s engages %s", " ".join(event), mode)
+        trace.record("command", mode)
+        self.engage_mode(mode, requested = received)
+
+
+    def control(self, command, received = None):
+        ''' Run a command from the control socket, returning what to answer with '''
+        recorder.record("command", command)
+        if command in MODES:
+            trace.record("command", command)
+        if command == "status":
+            return {"status": self.status()}
+        if command == "latency":
+            return {"latency": latency.summary(), "enabled": latency.enabled}
+        if command not in MODES:
+            raise ValueError("Unknown command \"{0}\"".format(command))
+        self.engage_mode(command, requested = received)
+
+
+    def status(self):
+        status = self.state()
+        sensor = getattr(self, "accelerometer_sensor", None)
+        status.update(
+            accelerometer = {
+                "running": sensor is not None,
+                "rate":    sensor.rate if sensor is not None else 0.0
+            },
+            applied = dict(self.reconciler.applied),
+            transition = self.reconciler.results,
+            palm_rejection = {
+                "state": self.palm_rejection.state,
+                "grace": self.palm_rejection.grace
+            },
+            devices = self.registry.roles,
+            outputs = self.outputs.states(),
+            backend = type(self.backend).__name__
+        )
+        return status
+
+
+    def sensor_listen(self):
+        for event in self.sensor_channel.get_all():
+            latency.record("channel " + event.kind, time.time() - event.timestamp)
+            if event.kind == "orientation":
+                if not self.locked:
+                    self.engage_mode(event.value, requested = event.timestamp)
+            elif event.kind == "stylus":
+                recorder.record("stylus", event.value)
+                trace.record("stylus", event.value)
+                self.stylus_proximity(event.value, requested = event.timestamp)
+                self.control_server.publish("stylus", event.value, event.timestamp)
+            elif event.kind == "candidate":
+                self.control_server.publish("candidate", event.value, event.timestamp)
+            elif event.kind == "outputs":
+                self.outputs_changed()
+            else:
+                log.error("Unknown sensor event {0}".format(event))
 
 
-    def accelerometer_listen(self):
-        if self.accelerometer_queue.empty():
+    def outputs_changed(self):
+        '''
+        Follow the touchscreen and stylus when the screen was rotated outside
+        spin, and map them again when the layout of the outputs changed.
+        '''
+        if self.reconciler.pending or self.reconciler.applied["orientation"] != self.orientation:
+            # A rotation of our own is under way.
             return
-        orientation = self.accelerometer_queue.get()
-        if not self.locked:
+        orientation = self.outputs.orientation()
+        if orientation is not None and orientation != self.orientation:
+            log.info("The screen was rotated to %s outside spin", orientation)
             self.engage_mode(orientation)
+        elif self.outputs.layout() != self.mapped_layout:
+            log.info("The screen layout changed, mapping the touchscreen and stylus again")
+            self.action_worker.submit("map inputs", [lambda: self.map_inputs()])
 
 
     def accelerometer_switch(self, status = None):
         if status == True:
             log.info("Turning accelerometer on")
-            self.accelerometer_process = Process(
-                target = acceleration_sensor,
-                args = (self.accelerometer_queue, self.orientation)
+            self.accelerometer_sensor = AccelerometerSensor(
+                self.sensor_channel,
+                OrientationEngine(self.orientation, hysteresis = self.hysteresis, dwell = self.dwell,
+                                  flat = self.flat),
+                root     = self.iio_root,
+                chardevs = self.iio_chardevs,
+                mounting = self.mounting
             )
-            self.accelerometer_process.start()
+            self.accelerometer_sensor.start()
         elif status == False:
             log.info("Turning accelerometer off")
-            if hasattr(self, 'accelerometer_process'):
-                self.accelerometer_process.terminate()
+            if getattr(self, "accelerometer_sensor", None) is not None:
+                self.accelerometer_sensor.stop()
+                self.accelerometer_sensor = None
         else:
             log.error("Unknown accelerometer status \"{0}\" requested".format(status))
             sys.exit()
 
 
+    def accelerometer_sync(self):
+        ''' Run the accelerometer only while the rotation is unlocked '''
+        running = getattr(self, "accelerometer_sensor", None) is not None
+        if running == self.locked:
+            self.accelerometer_switch(status = not self.locked)
+
+
     def acpi_switch(self, status = None):
         if status == True:
             log.info("Listening to ACPI events")
-            self.acpi_process = Process(
-                target = acpi_sensor,
-                args = (self.acpi_queue,)
-            )
-            self.acpi_process.start()
+            self.acpi_parser = AcpiEventParser()
+            self.acpi_last = {}
+            self.acpi_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.acpi_socket.connect(self.acpi_socket_path)
+            except socket.error as err:
+                log.error("Unable to listen to ACPI events: {0}".format(err))
+                self.acpi_socket.close()
+                self.acpi_socket = None
+                return
+            self.watch(self.acpi_socket.fileno(), self.acpi_listen)
         elif status == False:
             log.info("Stopped listening to ACPI events")
-            try:
-                self.acpi_process.terminate()
-            except:
-                pass
+            if getattr(self, "acpi_socket", None) is not None:
+                self.unwatch(self.acpi_socket.fileno())
+                self.acpi_socket.close()
+                self.acpi_socket = None
         else:
             log.error("unknown acpi control status \"{0}\" requested".format(status))
             sys.exit()
 
     
-    def engage_mode(self, mode = None):
-        log.info("Engage mode {mode}".format(mode = mode))
+    def engage_mode(self, mode = None, requested = None):
+        '''
+        Switch to mode, where requested is when the change was asked for.
+
+        The daemon state is updated right away, while the state reconciler
+        applies the resulting difference off the event loop.
+        '''
+        log.info("Engage mode %s", mode)
+        trace.record("engage", mode)
+        previous = self.state()
         if mode == "toggle":
             if self.mode == "laptop":
                 mode = "tablet"
             else:
                 mode = "laptop"
-            self.mode = mode
         if mode == "tablet":
             print(" *** TABLET ***")
-            self.nipple_switch(status = False) 
-            self.touchpad_switch(status = False)
+            self.mode = mode
             self.locked = False
-            os.system('notify-send "Tablet Mode"')
         elif mode == "laptop":
             print(" *** LAPTOP ***")
+            self.mode = mode
             self.locked = True
-            self.touchpad_switch(status = True)
-            self.nipple_switch(status = True)
-            self.display_orientation(orientation = "normal")
-            self.touchscreen_orientation(orientation = "normal")
-            self.set_calibration()
-            os.system("which i3-msg && i3-msg layout splith")
-            os.system('notify-send "Laptop Mode"')
+            self.orientation = "normal"
         elif mode in ["left", "right", "inverted", "normal"]:
-            self.display_orientation(orientation = mode)
-            self.touchscreen_orientation(orientation = mode)
-            self.set_calibration()
-            if mode in ["normal", "inverted"]:
-                os.system("which i3-msg && i3-msg layout splith")
-            else: # mode in ["left", "right"]
-                os.system("which i3-msg && i3-msg layout splitv")
+            self.orientation = mode
         elif mode == "togglelock":
-            if self.locked is True:
-                self.locked = False
-                log.info("Rotation lock disabled")
-                os.system('notify-send "Rotation Lock Disabled"')
-            else:
-                self.locked = True
-                log.info("Rotation lock enabled")
-                os.system('notify-send "Rotation Lock Enabled"')
+            self.locked = not self.locked
         elif mode == "toggletouch":
-            if self.touchy is True:
-                self.touchy = False
-                self.stylus_proximity_switch(status=False)
-                self.touchscreen_switch(status=False)
-                log.info("Touch screen disabled")
-                os.system('notify-send "Touch Screen Disabled"')
-            else:
-                self.touchy = True
-                self.stylus_proximity_switch(status=True)
-                self.touchscreen_switch(status=True)
-                log.info("Touch screen enabled")
-                os.system('notify-send "Touch Screen Enabled"')
+            self.touchy = not self.touchy
+            self.palm_rejection.enable(self.touchy)
+            self.stylus_proximity_switch(status = self.touchy)
         elif mode == "calibrate":
             print(" *** Calibrating Wacom Pen *** ")
-            self.calibrate()
+            self.action_worker.submit(mode, [lambda: self.calibrate()], requested)
+            return
         else:
             log.error("Unknown mode \"{mode}\" requested".format(mode = mode))
             sys.exit()
-        time.sleep(2)  # Switching modes too fast seems to cause trobule
+        state = self.state()
+        for kind in sorted(state):
+            if state[kind] != previous[kind]:
+                self.control_server.publish(kind, state[kind])
+        self.accelerometer_sync()
+        self.reconciler.request(requested = requested, **state)
+
+
+    def state(self):
+        return {
+            "mode":        self.mode,
+            "orientation": self.orientation,
+            "locked":      self.locked,
+            "touchy":      self.touchy
+        }
 
-    def set_calibration(self):
-        ''' Set the Wacom calibration for the current orientation '''
-        cal = Calibration(self.device_names['stylus'])
-        cal.set_calibration()
+
+    def transition(self, current, target):
+        '''
+        Return the ActionGraph that takes the devices from state current to
+        target. The touchscreen, stylus and window layout follow the display
+        rotation, while the pointing devices and notifications are independent.
+        '''
+        graph = ActionGraph()
+        if target["mode"] != current["mode"]:
+            graph.add("pointer", lambda: self.pointer_switch(status = target["mode"] == "laptop"), state = "mode")
+        if target["orientation"] != current["orientation"]:
+            orientation = target["orientation"]
+            if orientation in ["normal", "inverted"]:
+                layout = "splith"
+            else: # orientation in ["left", "right"]
+                layout = "splitv"
+            graph.add("display", lambda: self.display_orientation(orientation = orientation),
+                      state = "orientation")
+            graph.add("touchscreen matrix", lambda: self.touchscreen_orientation(orientation = orientation),
+                      after = "display", state = "orientation")
+            graph.add("stylus area", lambda: self.set_calibration(orientation = orientation),
+                      after = "display", state = "orientation")
+            if self.i3_msg is not None:
+                graph.add("i3 layout", lambda: self.backend.run([self.i3_msg, "layout", layout], "command i3-msg"),
+                          after = "display")
+        if target["touchy"] != current["touchy"]:
+            graph.add("touchscreen", lambda: self.touchscreen_switch(status = target["touchy"]),
+                      after = [step for step in ["display"] if step in graph], state = "touchy")
+            if target["touchy"]:
+                log.info("Touch screen enabled")
+                self.notify(graph, "Touch Screen Enabled")
+            else:
+                log.info("Touch screen disabled")
+                self.notify(graph, "Touch Screen Disabled")
+        if target["mode"] != current["mode"]:
+            if target["mode"] == "tablet":
+                self.notify(graph, "Tablet Mode")
+            else:
+                self.notify(graph, "Laptop Mode")
+        elif target["locked"] != current["locked"]:
+            if target["locked"]:
+                log.info("Rotation lock enabled")
+                self.notify(graph, "Rotation Lock Enabled")
+            else:
+                log.info("Rotation lock disabled")
+                self.notify(graph, "Rotation Lock Disabled")
+        return graph
+
+    def notify(self, graph, message):
+        ''' Add a desktop notification of message to graph '''
+        graph.add("notify " + message, lambda: self.backend.run(["notify-send", message]), timeout = 5.0)
+
+    def set_calibration(self, orientation = None):
+        ''' Set the Wacom calibration for orientation, the current one by default '''
+        if "stylus" not in self.device_names:
+            log.debug("Stylus calibration unchanged")
+            return
+        if orientation is None:
+            orientation = self.orientation
+        output = self.outputs.internal() or "*"
+        area = self.calibration_store.area(orientation, output = output)
+        log.info('Wacom stylus calibration set to %s for "%s" screen orientation', area, orientation)
+        with self.backend.batch():
+            for device in self.registry.devices("stylus") + self.registry.devices("eraser"):
+                self.backend.apply_area(device, self.calibration_store.prepared_area(orientation, device, output))
+
+
+    def calibrate(self):
+        ''' Calibrate the stylus for the current orientation '''
+        cal = Calibration(self.device_names["stylus"],
+                          backend     = self.backend,
+                          orientation = self.orientation,
+                          store       = self.calibration_store,
+                          output      = self.outputs.internal() or "*")
+        cal.calibrate()
 
 
     def is_touchscreen_alive(self):
         ''' Check if the touchscreen is responding '''
         log.debug("Waiting for touchscreen to respond")
-        status = os.system('xinput list | grep -q "{touchscreen}"'.format(touchscreen = self.device_names["touchscreen"]))
-        if status == 0:
-            return True
+        return self.registry.has("touchscreen")
+        
+
+def load_keyphrases(path = DEVICE_SETTINGS):
+    '''
+    Return the device keyphrases of every role, extended by the JSON object
+    of role to keyphrase list in path, if that file exists.
+    '''
+    keyphrases = dict((role, list(phrases)) for role, phrases in DEVICE_KEYPHRASES.iteritems())
+    if os.path.exists(path):
+        try:
+            with open(path) as settings:
+                for role, phrases in json.load(settings).iteritems():
+                    keyphrases.setdefault(role, []).extend(phrases)
+        except (IOError, ValueError, AttributeError) as err:
+            log.error("Ignoring device settings in {path}: {err}".format(path = path, err = err))
+    return keyphrases
+
+
+class DeviceRegistry():
+    '''
+    The attached input devices, indexed by role.
+
+    Every device whose name contains one of a role's keyphrases belongs to
+    that role. The index is kept up to date from device hotplug events when
+    watch() is running, so lookups never have to ask the X server.
+    '''
+
+    def __init__(self, backend, keyphrases = None):
+        self.backend = backend
+        if keyphrases is None:
+            keyphrases = load_keyphrases()
+        self.keyphrases = keyphrases
+        self.present = frozenset()
+        self.roles = dict((role, []) for role in keyphrases)
+        self.watching = False
+
+    def roles_of(self, name):
+        return [role for role, phrases in self.keyphrases.iteritems()
+                if any(phrase in name for phrase in phrases)]
+
+    def refresh(self):
+        ''' Update the index from the devices attached now '''
+        present = frozenset(self.backend.list_devices())
+        added = present - self.present
+        removed = self.present - present
+        if not added and not removed:
+            return
+        roles = dict((role, [name for name in devices if name in present])
+                     for role, devices in self.roles.iteritems())
+        for name in sorted(added):
+            for role in self.roles_of(name):
+                roles[role].append(name)
+                log.info(" - {role} detected as \"{name}\"".format(role = role.title(), name = name))
+        for name in removed:
+            for role in self.roles_of(name):
+                log.info(" - {role} \"{name}\" removed".format(role = role.title(), name = name))
+        self.roles = roles
+        self.present = present
+
+    def watch(self):
+        ''' Refresh the index on hotplug events in a background thread '''
+        def watch_devices():
+            self.watching = True
+            try:
+                self.backend.watch_devices(self.refresh)
+            except Exception as err:
+                log.warning("Not watching input device hotplug events: {0}".format(err))
+            self.watching = False
+        watcher = threading.Thread(target = watch_devices, name = "spin-devices")
+        watcher.daemon = True
+        watcher.start()
+
+    def devices(self, role):
+        ''' Return the names of the attached devices of role '''
+        return self.roles.get(role, [])
+
+    def has(self, role):
+        if not self.watching:
+            self.refresh()
+        return bool(self.roles.get(role))
+
+    def is_present(self, name):
+        ''' Return whether the device name is attached '''
+        if not self.watching:
+            self.refresh()
+        return name in self.present
+
+    def names(self):
+        ''' Return the first attached device of every role that has one '''
+        return dict((role, devices[0]) for role, devices in self.roles.iteritems() if devices)
+
+
+OutputState = namedtuple("OutputState", ["name", "connected", "primary", "orientation", "x", "y", "width", "height"])
+
+
+class OutputCache():
+    '''
+    The rotation and geometry of every RandR output.
+
+    The state is kept up to date from RandR change notifications when
+    watch() is running, so orientation queries never have to ask the X
+    server, and rotations made outside spin are noticed as they happen.
+    on_change is called, from the watching thread, after every change.
+    '''
+
+    def __init__(self, backend, on_change = None):
+        self.backend = backend
+        self.on_change = on_change
+        self.outputs = {}
+        self.watching = False
+
+    def refresh(self):
+        ''' Update the state of the outputs from the X server '''
+        try:
+            outputs = self.backend.list_outputs()
+        except Exception as err:
+            log.error("Unable to read the screen outputs: {0}".format(err))
+            return
+        if outputs == self.outputs:
+            return
+        for name in sorted(outputs):
+            if outputs[name] != self.outputs.get(name):
+                log.info(" - Output %s: %s", name, outputs[name])
+        self.outputs = outputs
+        if self.on_change is not None:
+            self.on_change()
+
+    def watch(self):
+        ''' Refresh the state on RandR events in a background thread '''
+        def watch_outputs():
+            self.watching = True
+            try:
+                self.backend.watch_outputs(self.refresh)
+            except ChannelClosed:
+                pass
+            except Exception as err:
+                log.warning("Not watching screen changes: {0}".format(err))
+            self.watching = False
+        watcher = threading.Thread(target = watch_outputs, name = "spin-outputs")
+        watcher.daemon = True
+        watcher.start()
+
+    def internal(self):
+        ''' Return the name of the built-in screen's output, or None '''
+        connected = sorted(name for name, state in self.outputs.iteritems() if state.connected)
+        for prefix in INTERNAL_OUTPUTS:
+            for name in connected:
+                if name.startswith(prefix):
+                    return name
+        for name in connected:
+            if self.outputs[name].primary:
+                return name
+        return connected[0] if connected else None
+
+    def orientation(self, output = None):
+        ''' Return the orientation of output, by default the built-in screen, or None '''
+        if not self.watching:
+            self.refresh()
+        if output is None:
+            output = self.internal()
+        state = self.outputs.get(output)
+        return state.orientation if state is not None else None
+
+    def geometry(self, output):
+        ''' Return the x, y, width and height of output on the screen, or None '''
+        state = self.outputs.get(output)
+        if state is None or not state.connected or state.width is None:
+            return None
+        return (state.x, state.y, state.width, state.height)
+
+    def screen(self):
+        ''' Return the width and height of the screen spanned by the outputs, or None '''
+        geometries = [geometry for geometry in (self.geometry(name) for name in self.outputs) if geometry]
+        if not geometries:
+            return None
+        return (max(x + width for x, y, width, height in geometries),
+                max(y + height for x, y, width, height in geometries))
+
+    def layout(self):
+        ''' Return the geometry and rotation of every connected output, to compare layouts '''
+        return tuple(sorted((name, self.geometry(name), state.orientation)
+                            for name, state in self.outputs.iteritems() if state.connected))
+
+    def states(self):
+        return dict((name, state._asdict()) for name, state in self.outputs.iteritems())
+
+
+def output_matrix(orientation, geometry, screen):
+    '''
+    Return the coordinate transformation matrix, as 9 floats in row order,
+    of an absolute input device on the output at geometry (x, y, width,
+    height) of a screen (width, height). The device is first rotated to
+    orientation within its unit square, if orientation is not None, then
+    scaled and moved onto the output's part of the screen.
+    '''
+    from numpy import array, dot, eye
+    x, y, width, height = geometry
+    screen_width, screen_height = screen
+    placement = array([[float(width) / screen_width, 0.0, float(x) / screen_width],
+                       [0.0, float(height) / screen_height, float(y) / screen_height],
+                       [0.0, 0.0, 1.0]])
+    if orientation is None:
+        rotation = eye(3)
+    else:
+        rotation = array(TOUCHSCREEN_MATRICES[orientation], dtype = float).reshape(3, 3)
+    return tuple(float(value) for value in dot(placement, rotation).flat)
+
+
+class InputTransforms():
+    '''
+    The coordinate transformation matrices of the absolute input devices.
+
+    X spreads absolute devices over the whole screen, so with more than one
+    output they have to be mapped onto their own output. Matrices are
+    memoized by rotation, output geometry and screen size, and so are only
+    computed again after the layout changes.
+    '''
+
+    def __init__(self):
+        self.matrices = {}
+
+    def matrix(self, orientation, geometry, screen):
+        ''' Return output_matrix(orientation, geometry, screen), computing it once '''
+        key = (orientation, tuple(geometry), tuple(screen))
+        if key not in self.matrices:
+            self.matrices[key] = output_matrix(orientation, geometry, screen)
+        return self.matrices[key]
+
+
+class PalmRejection():
+    '''
+    Keep the touchscreen off while the pen is near it.
+
+    Touch is switched off as soon as the pen comes into proximity, rather
+    than after the mode changes queued before it. When the pen leaves, touch
+    only comes back after grace seconds, so lifting the pen out of range in
+    the middle of a stroke does not let the palm through; the pen returning
+    within that time cancels the pending re-enable.
+
+    The state is "touch" while touch is on, "pen" while the pen is near,
+    "grace" while waiting to turn touch back on, and "off" while touch is
+    disabled altogether and left alone. switch(enabled) turns touch on or
+    off; it is called without holding the lock, so the pen is never kept
+    waiting by a slow switch. The reaction times are kept by the latency
+    recorder.
+    '''
+
+    def __init__(self, switch, grace = 0.5):
+        self.switch = switch
+        self.grace = grace
+        self.state = "touch"
+        self.timer = None
+        self.left = None
+        self.lock = threading.Lock()
+
+    def pen(self, proximity, timestamp = None):
+        ''' Handle the pen coming "in" or going "out" of proximity at timestamp '''
+        if timestamp is None:
+            timestamp = time.time()
+        off = False
+        with self.lock:
+            if self.state == "off":
+                return
+            if proximity == "in":
+                if self.state == "grace":
+                    self.timer.cancel()
+                    self.timer = None
+                    latency.record("palm pen return", timestamp - self.left)
+                    log.debug("Pen back within the grace period, touch stays off")
+                elif self.state == "touch":
+                    off = True
+                self.state = "pen"
+            elif proximity == "out" and self.state == "pen":
+                self.state = "grace"
+                self.left = timestamp
+                self.timer = threading.Timer(max(0.0, timestamp + self.grace - time.time()), self.expire)
+                self.timer.daemon = True
+                self.timer.start()
+        if off:
+            self.turn(False)
+            latency.record("palm touch off", time.time() - timestamp)
+
+    def expire(self):
+        with self.lock:
+            if self.state != "grace" or self.timer is not threading.current_thread():
+                return
+            self.timer = None
+            self.state = "touch"
+            left = self.left
+        self.turn(True)
+        latency.record("palm touch on", time.time() - left)
+
+    def enable(self, enabled):
+        ''' Take touch over again, or leave it alone while it is disabled altogether '''
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.state = "touch" if enabled else "off"
+
+    def stop(self):
+        ''' Turn touch back on if the pen had turned it off '''
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.state not in ["pen", "grace"]:
+                return
+            self.state = "touch"
+        self.turn(True)
+
+    def turn(self, enabled):
+        '''
+        Switch touch on or off outside the lock, as switch() may run a
+        command, then again for as long as the state changed meanwhile.
+        '''
+        while True:
+            try:
+                self.switch(enabled)
+            except Exception:
+                log.exception("Unable to turn touch %s", "on" if enabled else "off")
+            with self.lock:
+                if self.state == "off" or (self.state == "touch") == enabled:
+                    return
+                enabled = not enabled
+
+
+def query_stylus_proximity(device):
+    ''' Return the current stylus proximity, either "in" or "out" '''
+    stylus_proximity_command = "xinput query-state " + \
+                               "\""+device+"\" | " + \
+                               "grep Proximity | cut -d \" \" -f3 | " + \
+                               " cut -d \"=\" -f2"
+    return subprocess.check_output(
+        stylus_proximity_command,
+        shell = True
+    ).lower().rstrip()
+
+
+SensorEvent = namedtuple("SensorEvent", ["kind", "value", "timestamp"])
+
+
+class ChannelClosed(Exception):
+    pass
+
+
+class EventChannel():
+    '''
+    Bounded channel of SensorEvents from the sensor threads to the event loop.
+
+    put() blocks while the channel is full, so a flood of events slows down
+    its producer instead of growing without bound. fileno() is readable
+    while events are pending. close() makes blocked and later put() calls
+    raise ChannelClosed.
+    '''
+
+    def __init__(self, maxsize = 64):
+        self.maxsize = maxsize
+        self.events = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.pipe = os.pipe()
+        for fd in self.pipe:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.pipe[0]
+
+    def put(self, kind, value, timestamp = None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.condition:
+            while len(self.events) >= self.maxsize and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                raise ChannelClosed()
+            self.events.append(SensorEvent(kind, value, timestamp))
+            if len(self.events) == 1:
+                os.write(self.pipe[1], b"\0")
+
+    def get_all(self):
+        ''' Return and remove every pending event, without blocking '''
+        with self.condition:
+            try:
+                os.read(self.pipe[0], 64)
+            except OSError:
+                pass
+            events = list(self.events)
+            self.events.clear()
+            self.condition.notify_all()
+        return events
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for fd in self.pipe:
+            os.close(fd)
+
+
+class SensorThread(threading.Thread):
+    ''' Run a sensor loop in the background, posting events to a channel '''
+
+    def __init__(self, name, channel):
+        threading.Thread.__init__(self, name = name)
+        self.daemon = True
+        self.channel = channel
+        self.stopping = threading.Event()
+
+    def stop(self, timeout = 2.0):
+        self.stopping.set()
+        self.interrupt()
+        self.join(timeout)
+
+    def interrupt(self):
+        ''' Wake up a sense() blocked on something other than stopping '''
+        pass
+
+    def run(self):
+        try:
+            self.sense()
+        except ChannelClosed:
+            pass
+        except Exception:
+            log.exception("The %s sensor failed", self.name)
+            trace.dump()
+
+    def sense(self):
+        raise NotImplementedError
+
+
+class StylusSensor(SensorThread):
+    '''
+    Post the stylus proximity, "in" or "out", whenever it changes.
+
+    The proximity in/out events of the device are read from a single
+    long-running "xinput test -proximity" process. Polling is only used when
+    that event source is missing.
+    '''
+
+    def __init__(self, device, channel, interval = 0.15):
+        SensorThread.__init__(self, "spin-stylus", channel)
+        self.device = device
+        self.interval = interval
+        self.xinput_test = None
+
+    def interrupt(self):
+        if self.xinput_test is not None and self.xinput_test.poll() is None:
+            self.xinput_test.kill()
+
+    def sense(self):
+        previous = None
+        for proximity in self.proximity_events():
+            if proximity != previous:
+                self.channel.put("stylus", proximity)
+                previous = proximity
+
+    def proximity_events(self):
+        yield query_stylus_proximity(self.device)
+        try:
+            self.xinput_test = subprocess.Popen(
+                ["xinput", "test", "-proximity", self.device],
+                stdout = subprocess.PIPE,
+                stderr = subprocess.PIPE
+            )
+        except OSError as err:
+            log.warning("Unable to watch stylus proximity events: {0}".format(err))
+        else:
+            if self.stopping.is_set():
+                self.interrupt()
+            # readline() rather than iterating the file, which reads ahead.
+            for line in iter(self.xinput_test.stdout.readline, ""):
+                if line.startswith("proximity in"):
+                    yield "in"
+                elif line.startswith("proximity out"):
+                    yield "out"
+            status = self.xinput_test.wait()
+            if self.stopping.is_set():
+                return
+            log.warning("Stylus proximity events ended with status {0}".format(status))
+        log.warning("Falling back to polling the stylus proximity")
+        while not self.stopping.wait(self.interval):
+            yield query_stylus_proximity(self.device)
+
+
+class AccelerometerSensor(SensorThread):
+    '''
+    Post each new orientation candidate, and each new screen orientation the
+    engine detects. Without a mounting matrix, the one the kernel reports
+    for the accelerometer, if any, is used.
+
+    The accelerometer is read every fast seconds as soon as a sample differs
+    from the previous one by motion m/s^2 or more, and every slow seconds
+    once it has been still for still seconds. A buffered accelerometer is
+    asked to sample at that rate instead, where the device allows it.
+
+    A buffered read, which waits for the device, is woken up by stop(). The
+    device is opened by one sensor at a time, so a new sensor only starts
+    reading once the previous one has closed it.
+    '''
+
+    device_lock = threading.Lock()
+
+    def __init__(self, channel, engine, fast = 0.05, slow = 0.5, motion = 0.5, still = 2.0,
+                 root = IIO_DEVICES, chardevs = IIO_CHARDEVS, mounting = None):
+        SensorThread.__init__(self, "spin-accelerometer", channel)
+        self.engine = engine
+        self.fast = fast
+        self.slow = slow
+        self.motion = motion
+        self.still = still
+        self.interval = fast
+        self.moved = None
+        self.paced = False
+        self.reader = None
+        self.device_rate = None
+        self.root = root
+        self.chardevs = chardevs
+        self.mounting = mounting
+        self.wake = os.pipe()
+
+    def interrupt(self):
+        os.write(self.wake[1], b"x")
+
+    def stop(self, timeout = 2.0):
+        SensorThread.stop(self, timeout)
+        if self.is_alive():
+            log.warning("The accelerometer sensor did not stop within %s s", timeout)
+            return
+        for fd in self.wake:
+            os.close(fd)
+
+    @property
+    def rate(self):
+        ''' The current number of samples per second, or None when the device's is unknown '''
+        if self.paced:
+            return self.device_rate
+        return 1.0 / self.interval
+
+    def pace(self, interval):
+        ''' Read every interval seconds, or have a buffered device sample that often '''
+        self.interval = interval
+        if self.paced:
+            self.device_rate = self.reader.set_rate(1.0 / interval)
+
+    def adapt(self, sample, previous, timestamp):
+        ''' Sample fast while the acceleration changes, and slowly once it has been still a while '''
+        from numpy.linalg import norm
+        if previous is not None and norm(sample - previous) >= self.motion:
+            self.moved = timestamp
+            interval = self.fast
+        elif timestamp - self.moved >= self.still:
+            interval = self.slow
         else:
+            interval = self.interval
+        if interval != self.interval:
+            log.debug("Sampling the accelerometer at %.0f Hz", 1.0 / interval)
+            self.pace(interval)
+
+    def sense(self):
+        with self.device_lock:
+            if not self.stopping.is_set():
+                self.sense_device()
+
+    def sense_device(self):
+        reader = open_accelerometer(self.root, self.chardevs)
+        mounting = self.mounting
+        if mounting is None:
+            mounting = read_mount_matrix(reader.directory)
+        self.engine.mount(mounting)
+        # A buffered reader blocks until the device's own clock delivers a
+        # sample, so its rate is set on the device rather than waited out.
+        self.reader = reader
+        self.paced = reader.paced
+        # Being switched on usually means the screen is about to be turned.
+        self.pace(self.fast)
+        self.moved = time.time()
+        previous = None
+        try:
+            while not self.stopping.is_set():
+                if not self.paced and self.stopping.wait(self.interval):
+                    break
+                samples = reader.read_n(1, wake = self.wake[0])
+                if samples is None:
+                    break
+                sample = samples[0]
+                recorder.record("accel", sample.tolist())
+                trace.record("accel", sample)
+                self.adapt(sample, previous, time.time())
+                previous = sample
+                candidate = self.engine.candidate
+                with latency.span("orientation update"):
+                    orientation = self.engine.update(sample)
+                if self.engine.candidate != candidate:
+                    trace.record("candidate", self.engine.candidate)
+                    self.channel.put("candidate", self.engine.candidate)
+                if orientation is not None:
+                    trace.record("orientation", orientation)
+                    self.channel.put("orientation", orientation)
+        finally:
+            reader.close()
+
+
+def resident_memory():
+    ''' Return the resident memory of this process in kB, or None '''
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def io_syscalls():
+    ''' Return the number of read and write system calls made by this process, or None '''
+    try:
+        with open("/proc/self/io") as io:
+            counts = dict(line.split(":") for line in io)
+        return int(counts["syscr"]) + int(counts["syscw"])
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+def wait_for(condition, timeout = 10.0, interval = 0.1):
+    ''' Wait until condition() is true, returning False after timeout seconds '''
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() >= deadline:
             return False
-        
+        time.sleep(interval)
+    return True
+
+
+class LatencyRecorder():
+    '''
+    How long each stage of the daemon takes, by stage name.
 
-def get_inputs():
-    log.info("Audit Inputs:")
-    input_devices = subprocess.Popen(
-        ["xinput", "--list"],
-        stdin = subprocess.PIPE,
-        stdout = subprocess.PIPE,
-        stderr = subprocess.PIPE
-    ).communicate()[0]
-    devices_and_keyphrases = {
-        "touchscreen": ["SYNAPTICS Synaptics Touch Digitizer V04",
-                        "ELAN Touchscreen",
-                        "Wacom Co.,Ltd. Pen and multitouch sensor Finger touch"],
-        "touchpad":    ["PS/2 Synaptics TouchPad",
-                        "SynPS/2 Synaptics TouchPad",
-                        "ETPS/2 Elantech Touchpad"],
-        "nipple":      ["TPPS/2 IBM TrackPoint",
-                        "ETPS/2 Elantech TrackPoint"],
-        "stylus":      ["Wacom ISDv4 EC Pen stylus",
-                        "Wacom Co.,Ltd. Pen and multitouch sensor Pen stylus",
-                        "Wacom Co.,Ltd. Pen and multitouch sensor Pen eraser"]
+    The latest window durations of every stage are kept, and summarised as
+    their count, median, 95th percentile and maximum in seconds. Spans and
+    records are thread safe, and cost next to nothing while disabled.
+    '''
+
+    def __init__(self, enabled = False, window = 512):
+        self.enabled = enabled
+        self.window = window
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counts = {}
+
+    def record(self, stage, elapsed):
+        if not self.enabled:
+            return
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = deque(maxlen = self.window)
+                self.counts[stage] = 0
+            self.stages[stage].append(elapsed)
+            self.counts[stage] += 1
+
+    @contextmanager
+    def span(self, stage):
+        ''' Record how long the body of the with statement takes '''
+        if not self.enabled:
+            yield
+            return
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - started)
+
+    def durations(self, stage):
+        ''' Return the latest durations of stage '''
+        with self.lock:
+            return list(self.stages.get(stage, ()))
+
+    def summary(self):
+        with self.lock:
+            stages = dict((stage, list(durations)) for stage, durations in self.stages.iteritems())
+            counts = dict(self.counts)
+        return dict((stage, dict(percentiles(durations), count = counts[stage]))
+                    for stage, durations in stages.iteritems())
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counts = {}
+
+
+# The stage timings of this process, enabled by the daemon's --latency option.
+latency = LatencyRecorder()
+
+
+def percentiles(durations):
+    ''' Return the count, median, 95th percentile and maximum of durations '''
+    durations = sorted(durations)
+    if not durations:
+        return {"count": 0, "p50": None, "p95": None, "max": None}
+    return {
+        "count": len(durations),
+        "p50":   durations[int(round(0.50 * (len(durations) - 1)))],
+        "p95":   durations[int(round(0.95 * (len(durations) - 1)))],
+        "max":   durations[-1]
     }
-    device_names = {}
-    # TODO: allow for multiple devices of each type
-    for device, keyphrases in devices_and_keyphrases.iteritems():
-        for keyphrase in keyphrases:
-            if keyphrase in input_devices:
-                device_names[device] = keyphrase
-    for device, keyphrases in devices_and_keyphrases.iteritems():
-        if device in device_names:
-            log.info(" - {device} detected as \"{deviceName}\"".format(
-                device     = device.title(),
-                deviceName = device_names[device]
-            ))
+
+
+class EventRecorder():
+    '''
+    Write the inputs of the daemon to a capture file, for replaying them.
+
+    The file starts with a JSON header line, followed by one JSON line of
+    [seconds since the start, source, value] per input. The sources are
+    "accel" samples, raw "acpi" data, "stylus" proximity and control
+    socket "command"s. Nothing is written until open() is called.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.capture = None
+        self.started = None
+
+    def open(self, path):
+        self.capture = open(path, "w", 1)
+        self.started = time.time()
+        self.capture.write(json.dumps({"version": CAPTURE_VERSION, "started": self.started}) + "\n")
+
+    def record(self, source, value):
+        if self.capture is None:
+            return
+        with self.lock:
+            self.capture.write(json.dumps([round(time.time() - self.started, 4), source, value]) + "\n")
+
+    def close(self):
+        with self.lock:
+            if self.capture is not None:
+                self.capture.close()
+                self.capture = None
+
+
+# The capture written by the daemon's --record option.
+recorder = EventRecorder()
+
+
+class TraceBuffer():
+    '''
+    The latest sensor samples and decisions of the daemon, kept in memory to
+    find out after the fact why the screen rotated the way it did.
+
+    Records of time, source and value are packed into a fixed-size ring of
+    bytes, overwriting the oldest, so keeping them allocates nothing.
+    dump() writes them to a capture file, whose samples and stylus
+    proximity can be replayed, with the decisions along them. Nothing is
+    kept until open() is called. The modes of ACPI events are kept as
+    commands, as their raw data does not fit a record.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.codes = dict((value, code) for code, value in enumerate(TRACE_VALUES))
+        self.path = None
+        self.ring = None
+        self.size = 0
+        self.count = 0
+
+    def open(self, path, size = 4096):
+        self.path = path
+        self.size = size
+        self.ring = bytearray(size * TRACE_RECORD.size)
+        self.count = 0
+
+    def record(self, source, value):
+        if self.ring is None:
+            return
+        if source == "accel":
+            x, y, z = value
         else:
-            log.info(" - {device} not detected".format(
-                device = device.title()
-            ))
-    return(device_names)
+            x, y, z = self.codes.get(value, 0), 0.0, 0.0
+        with self.lock:
+            TRACE_RECORD.pack_into(self.ring, self.count % self.size * TRACE_RECORD.size,
+                                   time.time(), TRACE_SOURCES.index(source), x, y, z)
+            self.count += 1
+
+    def records(self):
+        ''' Return the (time, source, value) records kept, oldest first '''
+        with self.lock:
+            ring = bytes(self.ring)
+            count = self.count
+        records = []
+        for index in range(max(0, count - self.size), count):
+            timestamp, source, x, y, z = TRACE_RECORD.unpack_from(ring, index % self.size * TRACE_RECORD.size)
+            source = TRACE_SOURCES[source]
+            if source == "accel":
+                value = [round(x, 4), round(y, 4), round(z, 4)]
+            else:
+                value = TRACE_VALUES[int(x)]
+            records.append((timestamp, source, value))
+        return records
 
+    def dump(self, path = None):
+        ''' Write the records kept to path, by default the one given to open() '''
+        if self.ring is None:
+            return
+        if path is None:
+            path = self.path
+        records = self.records()
+        started = records[0][0] if records else time.time()
+        try:
+            with open(path, "w") as capture:
+                capture.write(json.dumps({"version": CAPTURE_VERSION, "started": started, "trace": True}) + "\n")
+                for timestamp, source, value in records:
+                    capture.write(json.dumps([round(timestamp - started, 4), source, value]) + "\n")
+        except IOError as err:
+            log.error("Failed to write the trace to %s: %s", path, err)
+            return
+        log.info("Wrote %d trace records to %s", len(records), path)
 
-def engage_command(command = None):
-    os.system(command)
 
+trace = TraceBuffer()
 
-def mean_list(lists = None):
-    return([sum(element)/len(element) for element in zip(*lists)])
 
+def load_capture(path):
+    ''' Return the (seconds, source, value) inputs of a capture written by EventRecorder '''
+    with open(path) as capture:
+        header = json.loads(capture.readline())
+        if header.get("version", 0) > CAPTURE_VERSION:
+            raise ValueError("Unsupported capture version {0}".format(header["version"]))
+        return [tuple(json.loads(line)) for line in capture if line.strip()]
 
-def acceleration_sensor(accelerometer_queue, old_orientation="normal"):
-    while True:
-        # Get the mean of recent acceleration vectors.
-        number_of_measurements = 6
-        measurements = []
-        for measurement in range(0, number_of_measurements):
-            time.sleep(0.25)
-            measurements.append(AccelerationVector())
-        stable_acceleration = mean_list(lists = measurements)
-        log.debug("Stable acceleration vector: {vector}".format(
-            vector = stable_acceleration
-        ))
-        # Using numpy to compare rotation vectors.
-        stable = array((stable_acceleration[0], stable_acceleration[1], stable_acceleration[2]))
-        normal = array((0.0, -1, 0))
-        right = array((-1.0, 0, 0))
-        inverted = array((0.0, 1, 0))
-        left = array((1.0, 0, 0))
-        d = {
-            "normal": dot(stable, normal) / norm(stable) / norm(normal),
-            "inverted": dot(stable, inverted) / norm(stable) / norm(inverted),
-            "left": dot(stable, left) / norm(stable) / norm(left),
-            "right": dot(stable, right) / norm(stable) / norm(right)
-        }
-        orientation = max(d, key=d.get)
-        if old_orientation != orientation:
-            old_orientation = orientation
-            accelerometer_queue.put(orientation)
-        time.sleep(0.15)
-
-
-def acpi_sensor(acpi_queue):
-    socket_ACPI = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    socket_ACPI.connect("/var/run/acpid.socket")
-    while True:
-        event_ACPI = socket_ACPI.recv(4096)
-        log.debug("ACPI event: {0}".format(event_ACPI))
-        display_position_event = "ibm/hotkey LEN0068:00 00000080 000060c0\n"
-        rotation_lock_event = "ibm/hotkey LEN0068:00 00000080 00006020\n"
-        tablet_mode_event = " PNP0C14:04 000000b0 00000000\n"
-        if event_ACPI == rotation_lock_event:
-            acpi_queue.put("togglelock")
-        elif event_ACPI == display_position_event:
-            log.info("Display position changed. Event not implemented.")
-            acpi_queue.put("display_position_change")
-        elif event_ACPI == tablet_mode_event:
-            log.info("Tablet mode changed.")
-            acpi_queue.put("tablet_mode_change")
+
+class ActionWorker(threading.Thread):
+    '''
+    Run the actions of mode changes one job at a time, in submission order.
+
+    Each job is a list of callables. Waiting for devices to settle happens in
+    the actions themselves, so nothing here sleeps a fixed time.
+    '''
+
+    def __init__(self):
+        threading.Thread.__init__(self, name = "spin-actions")
+        self.daemon = True
+        self.jobs = Queue.Queue()
+
+    def submit(self, description, actions, requested = None):
+        ''' Queue actions, where requested is when the change was asked for '''
+        self.jobs.put((description, actions, requested, time.time()))
+
+    def stop(self, timeout = 30.0):
+        ''' Finish the queued jobs and end the worker '''
+        self.jobs.put(None)
+        self.join(timeout)
+
+    def run(self):
+        for job in iter(self.jobs.get, None):
+            description, actions, requested, submitted = job
+            latency.record("worker queue", time.time() - submitted)
+            with latency.span("job " + description):
+                for action in actions:
+                    try:
+                        action()
+                    except Exception:
+                        log.exception("Failed to engage %s", description)
+                        break
+            if requested is not None:
+                latency.record("requested to engaged", time.time() - requested)
+                log.info("Engaged %s %.3f s after it was requested", description, time.time() - requested)
+
+
+ActionStep = namedtuple("ActionStep", ["name", "action", "after", "timeout", "state"])
+
+
+class ActionGraph():
+    '''
+    The actions of a state transition, as named steps that run after others.
+
+    A step may only come after steps added before it, so the graph never
+    has a cycle. A step may name the part of the daemon state it applies,
+    which only counts as applied when the step succeeds.
+    '''
+
+    def __init__(self):
+        self.steps = []
+
+    def add(self, name, action, after = (), timeout = 10.0, state = None):
+        ''' Add the step name, running action after the step or steps after '''
+        if isinstance(after, basestring):
+            after = [after]
+        for step in after:
+            if step not in self:
+                raise ValueError("Step {name} comes after unknown step {step}".format(name = name, step = step))
+        if name in self:
+            raise ValueError("Duplicate step {0}".format(name))
+        self.steps.append(ActionStep(name, action, tuple(after), timeout, state))
+
+    def __contains__(self, name):
+        return any(step.name == name for step in self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+
+class ActionExecutor():
+    '''
+    Run the steps of ActionGraphs on a bounded pool of worker threads.
+
+    A step starts as soon as the steps it comes after have succeeded, so
+    independent steps run at the same time. A step fails when its action
+    raises, and is given up on after its timeout, although it cannot be
+    interrupted; the steps after a failed one are skipped.
+    '''
+
+    def __init__(self, workers = 4):
+        self.size = workers
+        self.workers = []
+        self.tasks = Queue.Queue()
+
+    def work(self):
+        for task in iter(self.tasks.get, None):
+            name, action, results = task
+            started = time.time()
+            try:
+                result, status = action(), "ok"
+            except Exception as err:
+                log.exception("Step %s failed", name)
+                result, status = str(err), "failed"
+            results.put((name, status, result, time.time() - started))
+
+    def submit(self, task):
+        if len(self.workers) < self.size:
+            worker = threading.Thread(target = self.work, name = "spin-step-{0}".format(len(self.workers)))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.tasks.put(task)
+
+    def run(self, graph):
+        '''
+        Run the steps of graph, and return the outcome of each by name, as a
+        dict of its "status" (ok, failed, timeout or skipped), "elapsed"
+        seconds and the "result" its action returned, or its error.
+        '''
+        results = Queue.Queue()
+        outcomes = {}
+        running = {}
+        waiting = list(graph.steps)
+        while waiting or running:
+            for step in list(waiting):
+                statuses = [outcomes[name]["status"] if name in outcomes else None for name in step.after]
+                if all(status == "ok" for status in statuses):
+                    # Results are awaited without a timeout, which would poll.
+                    timer = threading.Timer(step.timeout, results.put, [(step.name, "timeout", None, step.timeout)])
+                    timer.daemon = True
+                    timer.start()
+                    running[step.name] = timer
+                    self.submit((step.name, step.action, results))
+                elif any(status not in [None, "ok"] for status in statuses):
+                    outcomes[step.name] = {"status": "skipped", "elapsed": 0.0, "result": None}
+                else:
+                    continue
+                waiting.remove(step)
+            if not running:
+                continue
+            name, status, result, elapsed = results.get()
+            if name not in running:
+                # The step finished after it was given up on.
+                continue
+            running.pop(name).cancel()
+            latency.record("step " + name, elapsed)
+            if status == "timeout":
+                log.error("Step %s did not finish within %s s", name, elapsed)
+            outcomes[name] = {"status": status, "elapsed": elapsed, "result": result}
+        return outcomes
+
+    def stop(self):
+        for worker in self.workers:
+            self.tasks.put(None)
+
+
+class StateReconciler():
+    '''
+    Collapse requested state changes into one desired state.
+
+    Requests only update the desired state. At most one reconcile job is
+    pending on the action worker at a time. It waits up to debounce seconds
+    for a burst of requests to settle, then applies only the difference
+    between the applied and the latest desired state, so intermediate and
+    no-op transitions cost nothing. The transition is an ActionGraph, run
+    by executor; the outcome of its steps is kept in results. A part of the
+    state whose steps did not all succeed stays as it was in applied, so
+    the next request tries it again.
+    '''
+
+    def __init__(self, worker, transition, executor, debounce = 0.1, **state):
+        self.worker = worker
+        self.transition = transition
+        self.executor = executor
+        self.debounce = debounce
+        self.results = {}
+        self.applied = dict(state)
+        self.desired = dict(state)
+        self.lock = threading.Lock()
+        self.pending = False
+        self.requested = None
+        self.changed = None
+
+    def request(self, requested = None, **changes):
+        ''' Update the desired state, where requested is when it was asked for '''
+        now = time.time()
+        if requested is None:
+            requested = now
+        with self.lock:
+            self.desired.update(changes)
+            self.changed = now
+            if self.requested is None or requested < self.requested:
+                self.requested = requested
+            if self.pending:
+                return
+            self.pending = True
+        self.worker.submit("state", [self.reconcile])
+
+    def reconcile(self):
+        ''' Apply the latest desired state; runs on the action worker '''
+        with latency.span("reconcile debounce"):
+            wait_for(lambda: time.time() - self.changed >= self.debounce,
+                     timeout = self.debounce, interval = self.debounce / 4)
+        with self.lock:
+            target = dict(self.desired)
+            requested = self.requested
+            self.pending = False
+            self.requested = None
+        current = self.applied
+        if target == current:
+            log.debug("Desired state %s is already applied", target)
+            return
+        graph = self.transition(current, target)
+        self.results = self.executor.run(graph)
+        applied = dict(target)
+        for step in graph.steps:
+            if step.state is not None and self.results[step.name]["status"] != "ok":
+                applied[step.state] = current[step.state]
+        self.applied = applied
+        if applied != target:
+            log.error("Failed to apply %s, keeping %s", target, applied)
+            return
+        latency.record("requested to applied", time.time() - requested)
+        log.info("Applied %s %.3f s after it was requested", target, time.time() - requested)
+
+
+class ControlConnection():
+    ''' A client of the control server, with its partial input and pending output '''
+
+    def __init__(self, client):
+        self.socket = client
+        self.fd = client.fileno()
+        self.inbox = ""
+        self.outbox = ""
+        self.writing = False
+        self.subscribed = False
+        self.events = deque()
+        self.dropped = 0
+        self.ended = False
+
+
+class ControlServer():
+    '''
+    Serve the control protocol on a UNIX stream socket at path.
+
+    Requests and responses are JSON objects, one per line. A request such as
+    {"version": 1, "id": 3, "commands": ["toggle", "status"]} runs each
+    command through handle(command, received), and is answered with
+    {"version": 1, "id": 3, "ok": true, "elapsed": ..., "results": [...]},
+    holding one result per command with its own "ok" and "elapsed". A line
+    that is not JSON is run as a single bare command.
+
+    The sockets are non-blocking, and every wakeup handles all pending
+    connections and requests, so a burst of commands costs one wakeup. A
+    client that shuts down its side after its requests is still answered,
+    and the connection is closed once the answers are sent.
+
+    The "subscribe" command makes the connection a subscriber, which is
+    sent every published event as a line such as
+    {"version": 1, "event": "mode", "value": "tablet", "time": ...}. Each
+    subscriber has a buffer of at most backlog events waiting to be sent.
+    Events of the COALESCED_EVENTS kinds replace a waiting event of the same
+    kind, and when the buffer is full the oldest event is dropped; the next
+    event sent then carries the number of events dropped.
+    '''
+
+    def __init__(self, path, watch, unwatch, handle, backlog = 32):
+        self.path = path
+        self.watch = watch
+        self.unwatch = unwatch
+        self.handle = handle
+        self.backlog = backlog
+        self.connections = {}
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.setblocking(0)
+        self.server.bind(path)
+        self.server.listen(8)
+        self.watch(self.server.fileno(), self.accept)
+
+    def accept(self):
+        while True:
+            try:
+                client, address = self.server.accept()
+            except socket.error:
+                # No more pending connections
+                return
+            client.setblocking(0)
+            connection = ControlConnection(client)
+            self.connections[connection.fd] = connection
+            self.watch(connection.fd, lambda connection = connection: self.read(connection))
+
+    def read(self, connection):
+        ended = False
+        while True:
+            try:
+                data = connection.socket.recv(4096)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                log.debug("Control connection failed: %s", err)
+                self.close(connection)
+                return
+            if not data:
+                ended = True
+                break
+            connection.inbox += data
+        lines = connection.inbox.split("\n")
+        connection.inbox = lines.pop()
+        if ended:
+            # The last request of a client that shut down may lack its newline.
+            lines.append(connection.inbox)
+            connection.inbox = ""
+        for line in lines:
+            if line.strip():
+                self.send(connection, self.respond(line, connection))
+        if ended and connection.fd in self.connections:
+            connection.ended = True
+            self.unwatch(connection.fd)
+            self.flush(connection)
+
+    def respond(self, line, connection = None):
+        ''' Run the commands of one request line, and return the response '''
+        received = time.time()
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = {"commands": [line.strip()]}
+        if not isinstance(request, dict):
+            request = {"commands": [request]}
+        response = {"version": PROTOCOL_VERSION, "id": request.get("id")}
+        if request.get("version", PROTOCOL_VERSION) > PROTOCOL_VERSION:
+            response.update(
+                ok      = False,
+                error   = "Unsupported protocol version {0}".format(request["version"]),
+                results = []
+            )
+        elif not isinstance(request.get("commands", []), list):
+            response.update(
+                ok      = False,
+                error   = "The commands must be a list",
+                results = []
+            )
+        else:
+            commands = request.get("commands", [])
+            if "command" in request:
+                commands = [request["command"]] + commands
+            response["results"] = [self.run(command, received, connection) for command in commands]
+            response["ok"] = all(result["ok"] for result in response["results"])
+        response["elapsed"] = time.time() - received
+        latency.record("control request", response["elapsed"])
+        return response
+
+    def run(self, command, received, connection = None):
+        started = time.time()
+        result = {"command": command}
+        try:
+            if command in ["subscribe", "unsubscribe"] and connection is not None:
+                connection.subscribed = command == "subscribe"
+            else:
+                result.update(self.handle(command, received) or {})
+            result["ok"] = True
+        except ValueError as err:
+            result.update(ok = False, error = str(err))
+        result["elapsed"] = time.time() - started
+        return result
+
+    def send(self, connection, message):
+        connection.outbox += json.dumps(message, sort_keys = True) + "\n"
+        self.flush(connection)
+
+    def publish(self, kind, value, timestamp = None):
+        ''' Send an event to every subscriber '''
+        if timestamp is None:
+            timestamp = time.time()
+        event = {"version": PROTOCOL_VERSION, "event": kind, "value": value, "time": timestamp}
+        for connection in self.connections.values():
+            if not connection.subscribed:
+                continue
+            if kind in COALESCED_EVENTS:
+                for waiting in list(connection.events):
+                    if waiting["event"] == kind:
+                        connection.events.remove(waiting)
+            if len(connection.events) >= self.backlog:
+                connection.events.popleft()
+                connection.dropped += 1
+            connection.events.append(event)
+            self.flush(connection)
+
+    def flush(self, connection):
+        ''' Write as much pending output as the socket takes, then wait for it to drain '''
+        # Events are only serialised once the previous output is sent, so
+        # that they can still be coalesced or dropped while they wait.
+        while True:
+            if not connection.outbox and connection.events:
+                event = connection.events.popleft()
+                if connection.dropped:
+                    event = dict(event, dropped = connection.dropped)
+                    connection.dropped = 0
+                connection.outbox = json.dumps(event, sort_keys = True) + "\n"
+            if not self.write(connection):
+                return
+            if connection.ended and not connection.outbox:
+                self.close(connection)
+                return
+            if connection.outbox or not connection.events:
+                return
+
+    def write(self, connection):
+        ''' Send what the socket takes of the output, returning False if the connection failed '''
+        try:
+            sent = connection.socket.send(connection.outbox)
+        except socket.error as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                log.debug("Control connection failed: %s", err)
+                self.close(connection)
+                return False
+            sent = 0
+        connection.outbox = connection.outbox[sent:]
+        if connection.outbox and not connection.writing:
+            self.watch(connection.fd, lambda: self.flush(connection), write = True)
+            connection.writing = True
+        elif not connection.outbox and connection.writing:
+            self.unwatch(connection.fd, write = True)
+            connection.writing = False
+        return True
+
+    def close(self, connection):
+        self.unwatch(connection.fd)
+        if connection.writing:
+            self.unwatch(connection.fd, write = True)
+        self.connections.pop(connection.fd, None)
+        connection.socket.close()
+
+    def shutdown(self):
+        for connection in self.connections.values():
+            self.close(connection)
+        self.unwatch(self.server.fileno())
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class CommandError(Exception):
+    pass
+
+
+def find_command(name):
+    ''' Return the path of the executable name in PATH, or None '''
+    for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def engage_command(command = None, stage = None, timeout = 10.0):
+    '''
+    Run a command, a list of arguments or a string split like a shell would,
+    without a shell. It is timed as stage, by default the name of the command,
+    and killed after timeout seconds. Return its exit status, which is
+    negative when it was killed, or None when it could not be started.
+    '''
+    if isinstance(command, basestring):
+        command = shlex.split(command)
+    if stage is None:
+        stage = "command " + os.path.basename(command[0])
+    with latency.span(stage):
+        try:
+            process = subprocess.Popen(command, close_fds = True)
+        except OSError as err:
+            log.error("Unable to run %s: %s", command[0], err)
+            return None
+        def kill():
+            try:
+                process.kill()
+            except OSError:
+                pass
+        killer = threading.Timer(timeout, kill)
+        killer.daemon = True
+        killer.start()
+        started = time.time()
+        status = process.wait()
+        killer.cancel()
+    if status != 0:
+        if time.time() - started >= timeout:
+            log.error("%s was killed after %s s", command[0], timeout)
         else:
-            log.info("Unknown acpi event triggered: {0}".format(event_ACPI))
-            acpi_queue.put("unknown")
-        time.sleep(0.1)
-    socket_ACPI.close()
+            log.warning("%s exited with status %s", command[0], status)
+    return status
 
 
-# TODO! Make variable names consistent.
-class AccelerationVector(list):
+class XBackend(object):
+    '''
+    Interface to the X server settings that spin changes.
+
+    Changes made inside a batch() block may be held back and sent together
+    when the outermost block ends. Outside of a batch they apply at once.
+    '''
 
     def __init__(self):
-        list.__init__(self)  
-        # Access the IIO interface to the accelerometer.
-        devicesDirectories = glob.glob("/sys/bus/iio/devices/iio:device*")
-        for directory in devicesDirectories:
-            if "accel_3d" in open(os.path.join(directory, "name")).read():
-                self.accelerometerDirectory = directory
-        self.accelerometerScaleFileFullPath =\
-            self.accelerometerDirectory + "/" + "in_accel_scale"
-        self.accelerometerAxisxFileFullPath =\
-            self.accelerometerDirectory + "/" + "in_accel_x_raw"
-        self.accelerometerAxisyFileFullPath =\
-            self.accelerometerDirectory + "/" + "in_accel_y_raw"
-        self.accelerometerAxiszFileFullPath =\
-            self.accelerometerDirectory + "/" + "in_accel_z_raw"
-        self.accelerometerScaleFile = open(self.accelerometerScaleFileFullPath)
-        self.accelerometerAxisxFile = open(self.accelerometerAxisxFileFullPath)
-        self.accelerometerAxisyFile = open(self.accelerometerAxisyFileFullPath)
-        self.accelerometerAxiszFile = open(self.accelerometerAxiszFileFullPath)
-        # Access the scale.
-        self.scale = float(self.accelerometerScaleFile.read())
-        # Initialise the vector.
-        self.extend([0, 0, 0])
-        self.update()
-
-    def update(self):
-        # Access the acceleration.
-        self.accelerometerAxisxFile.seek(0)
-        self.accelerometerAxisyFile.seek(0)
-        self.accelerometerAxiszFile.seek(0)
-        acceleration_x = float(self.accelerometerAxisxFile.read()) * self.scale
-        acceleration_y = float(self.accelerometerAxisyFile.read()) * self.scale
-        acceleration_z = float(self.accelerometerAxiszFile.read()) * self.scale
-        # Update the vector.
-        self[0] = acceleration_x
-        self[1] = acceleration_y
-        self[2] = acceleration_z
-
-    def __repr__(self):
-        self.update()
-        return(list.__repr__(self))
-
-
-def send_command(command):
-    if os.path.exists(SPIN_SOCKET):
-        command_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.batches = threading.local()
+
+    @contextmanager
+    def batch(self):
+        self.batches.depth = getattr(self.batches, "depth", 0) + 1
         try:
-            command_socket.connect(SPIN_SOCKET)
-            command_socket.send(command)
-            log.info("Connected to socket")
-        except:
-            log.info("Failed to send mode change to the spin daemon")
-    else:
+            yield self
+        finally:
+            self.batches.depth -= 1
+            if not self.batches.depth:
+                self.flush()
+
+    def changed(self):
+        ''' Flush a change right away unless it is part of a batch '''
+        if not getattr(self.batches, "depth", 0):
+            self.flush()
+
+    def flush(self):
+        pass
+
+    def run(self, command, stage = None, timeout = 10.0):
+        '''
+        Run a command that is not an X setting, such as a notification, and
+        return its exit status, raising CommandError if it failed.
+        '''
+        status = engage_command(command, stage, timeout)
+        if status != 0:
+            if not isinstance(command, basestring):
+                command = " ".join(command)
+            raise CommandError("{command} failed with status {status}".format(command = command, status = status))
+        return status
+
+    def rotate(self, orientation):
+        raise NotImplementedError
+
+    def set_matrix(self, device, matrix):
+        ''' Set the coordinate transformation matrix of an input device '''
+        raise NotImplementedError
+
+    def set_area(self, device, area):
+        ''' Set the Wacom tablet area [minx, miny, maxx, maxy] of a device '''
+        raise NotImplementedError
+
+    def prepare_area(self, device, area):
+        ''' Return the arguments that set the area of device, for apply_area() '''
+        return list(area)
+
+    def apply_area(self, device, prepared):
+        ''' Set an area of device, as returned by prepare_area() '''
+        self.set_area(device, prepared)
+
+    def get_area(self, device):
+        raise NotImplementedError
+
+    def set_enabled(self, device, enabled):
+        raise NotImplementedError
+
+    def list_devices(self):
+        ''' Return the names of the attached input devices '''
+        raise NotImplementedError
+
+    def watch_devices(self, callback):
+        ''' Call callback whenever input devices are added or removed; blocks '''
+        raise NotImplementedError
+
+    def list_outputs(self):
+        ''' Return the OutputState of every RandR output, by name '''
+        raise NotImplementedError
+
+    def watch_outputs(self, callback):
+        ''' Call callback whenever the screen, a CRTC or an output changes; blocks '''
+        raise NotImplementedError
+
+
+class CommandBackend(XBackend):
+    '''
+    Change X settings with the xrandr, xinput and xsetwacom commands, raising
+    CommandError when one fails.
+    '''
+
+    def rotate(self, orientation):
+        self.run(["xrandr", "-o", orientation])
+
+    def set_matrix(self, device, matrix):
+        self.run(["xinput", "set-prop", device, "Coordinate Transformation Matrix"] +
+                 [str(value) for value in matrix])
+
+    def set_area(self, device, area):
+        self.apply_area(device, self.prepare_area(device, area))
+
+    def prepare_area(self, device, area):
+        return ["xsetwacom", "--set", device, "Area"] + [str(value) for value in area]
+
+    def apply_area(self, device, prepared):
+        log.debug("Ran %s", prepared)
+        self.run(prepared)
+
+    def get_area(self, device):
+        current_area = subprocess.check_output(
+            ['xsetwacom',
+             '--get',
+             '{device}'.format(device = device),
+             'Area'])
+        return [int(value) for value in current_area.split()]
+
+    def set_enabled(self, device, enabled):
+        self.run(["xinput", "enable" if enabled else "disable", device])
+
+    def list_devices(self):
+        return subprocess.check_output(["xinput", "--list", "--name-only"]).splitlines()
+
+    def watch_devices(self, callback):
+        # X picks up a hotplugged device shortly after udev announces it.
+        udevadm = subprocess.Popen(
+            ["udevadm", "monitor", "--udev", "--subsystem-match=input"],
+            stdout = subprocess.PIPE
+        )
+        for line in iter(udevadm.stdout.readline, ""):
+            if line.startswith("UDEV"):
+                callback()
+                time.sleep(0.5)
+                callback()
+        raise IOError("udevadm monitor exited with status {0}".format(udevadm.wait()))
+
+    def list_outputs(self):
+        outputs = {}
+        for line in subprocess.check_output(["xrandr", "-q"]).splitlines():
+            match = XRANDR_OUTPUT.match(line)
+            if match is None:
+                continue
+            name, connection, primary, width, height, x, y, orientation = match.groups()
+            if width is not None and orientation is None:
+                orientation = "normal"
+            geometry = [int(value) if value is not None else None for value in (x, y, width, height)]
+            outputs[name] = OutputState(name, connection == "connected", bool(primary), orientation, *geometry)
+        return outputs
+
+    def watch_outputs(self, callback):
+        xev = subprocess.Popen(["xev", "-root", "-event", "randr"], stdout = subprocess.PIPE)
+        fd = xev.stdout.fileno()
+        callback()
+        while True:
+            data = os.read(fd, 4096)
+            if not data:
+                break
+            if "RR" not in data:
+                continue
+            # One change is reported several times; let the burst pass, then refresh once.
+            while select.select([fd], [], [], 0.1)[0]:
+                if not os.read(fd, 4096):
+                    break
+            callback()
+        raise IOError("xev exited with status {0}".format(xev.wait()))
+
+
+class XlibBackend(XBackend):
+    '''
+    Change X settings over one long-lived connection, using the RandR and
+    XInput extensions through python-xlib.
+
+    The connection is reopened in a forked process rather than shared.
+    '''
+
+    rotations = {"normal": 1, "left": 2, "inverted": 4, "right": 8}
+
+    def __init__(self, display = None):
+        super(XlibBackend, self).__init__()
+        self.display_name = display
+        self.connect()
+
+    def connect(self):
+        # The connection is shared by the event loop and the action threads.
+        import Xlib.threaded
+        from Xlib import display
+        from Xlib.ext import xinput
+        self.display = display.Display(self.display_name)
+        for extension in ("RANDR", "XInputExtension"):
+            if not self.display.has_extension(extension):
+                raise IOError("The X server lacks the {0} extension".format(extension))
+        self.root = self.display.screen().root
+        self.all_devices = xinput.AllDevices
+        self.atoms = {}
+        self.device_ids = {}
+        self.pid = os.getpid()
+
+    def connection(self):
+        if self.pid != os.getpid():
+            self.connect()
+        return self.display
+
+    def atom(self, name):
+        if name not in self.atoms:
+            self.atoms[name] = self.connection().intern_atom(name)
+        return self.atoms[name]
+
+    def list_devices(self):
+        devices = self.connection().xinput_query_device(self.all_devices).devices
+        self.device_ids = dict((device.name, device.deviceid) for device in devices)
+        return list(self.device_ids)
+
+    def watch_devices(self, callback):
+        from Xlib import display
+        from Xlib.ext import ge, xinput
+        # Events are read on a connection of their own.
+        events = display.Display(self.display_name)
+        events.screen().root.xinput_select_events([(xinput.AllDevices, xinput.HierarchyChangedMask)])
+        callback()
+        while True:
+            event = events.next_event()
+            if event.type == ge.GenericEventCode and event.evtype == xinput.HierarchyChanged:
+                callback()
+
+    def list_outputs(self):
+        display = self.connection()
+        resources = self.root.xrandr_get_screen_resources()
+        try:
+            primary = self.root.xrandr_get_output_primary().output
+        except Exception:
+            primary = None
+        orientations = dict((rotation, orientation) for orientation, rotation in self.rotations.iteritems())
+        outputs = {}
+        for output in resources.outputs:
+            info = display.xrandr_get_output_info(output, resources.config_timestamp)
+            orientation, geometry = None, (None, None, None, None)
+            if info.crtc:
+                crtc = display.xrandr_get_crtc_info(info.crtc, resources.config_timestamp)
+                orientation = orientations.get(crtc.rotation & 0xf, "normal")
+                geometry = (crtc.x, crtc.y, crtc.width, crtc.height)
+            outputs[info.name] = OutputState(info.name, info.connection == 0, output == primary,
+                                             orientation, *geometry)
+        return outputs
+
+    def watch_outputs(self, callback):
+        from Xlib import display
+        from Xlib.ext import randr
+        # Events are read on a connection of their own.
+        events = display.Display(self.display_name)
+        events.screen().root.xrandr_select_input(
+            randr.RRScreenChangeNotifyMask | randr.RRCrtcChangeNotifyMask | randr.RROutputChangeNotifyMask
+        )
+        callback()
+        while True:
+            events.next_event()
+            # One change is reported several times; refresh once for the lot.
+            while events.pending_events():
+                events.next_event()
+            callback()
+
+    def device_id(self, device):
+        if device not in self.device_ids:
+            self.list_devices()
+        return self.device_ids[device]
+
+    def flush(self):
+        self.connection().sync()
+
+    def rotate(self, orientation):
+        info = self.root.xrandr_get_screen_info()
+        self.root.xrandr_set_screen_config(info.size_id, self.rotations[orientation], info.config_timestamp)
+        self.changed()
+
+    def set_property(self, device, name, kind, data):
+        self.connection().xinput_change_device_property(
+            self.device_id(device), self.atom(name), self.atom(kind), 0, data
+        )
+        self.changed()
+
+    def set_matrix(self, device, matrix):
+        self.set_property(device, "Coordinate Transformation Matrix", "FLOAT",
+                          (32, struct.pack("=9f", *matrix)))
+
+    def set_area(self, device, area):
+        self.apply_area(device, self.prepare_area(device, area))
+
+    def prepare_area(self, device, area):
+        return (32, struct.pack("=4i", *[int(value) for value in area]))
+
+    def apply_area(self, device, prepared):
+        self.set_property(device, "Wacom Tablet Area", "INTEGER", prepared)
+
+    def get_area(self, device):
+        reply = self.connection().xinput_get_device_property(
+            self.device_id(device), self.atom("Wacom Tablet Area"), 0, 0, 4
+        )
+        return list(struct.unpack("=4i", reply.value[1].tostring()))
+
+    def set_enabled(self, device, enabled):
+        self.set_property(device, "Device Enabled", "INTEGER",
+                          (8, b"\x01" if enabled else b"\x00"))
+
+
+class FakeBackend(XBackend):
+    ''' Record X changes and shell commands in memory instead of applying them, for tests '''
+
+    def __init__(self, devices = (), area = (0, 0, 1000, 1000)):
+        super(FakeBackend, self).__init__()
+        self.devices = set(devices)
+        self.default_area = list(area)
+        self.calls = []
+        self.flushes = 0
+        self.orientation = "normal"
+        self.outputs = {"eDP1": OutputState("eDP1", True, True, "normal", 0, 0, 1920, 1080)}
+        self.matrices = {}
+        self.areas = {}
+        self.enabled = {}
+
+    def flush(self):
+        self.flushes += 1
+
+    def run(self, command, stage = None, timeout = 10.0):
+        self.calls.append(("run", command))
+        return 0
+
+    def rotate(self, orientation):
+        self.calls.append(("rotate", orientation))
+        state = self.outputs["eDP1"]
+        if (orientation in ["left", "right"]) != (state.orientation in ["left", "right"]):
+            state = state._replace(width = state.height, height = state.width)
+        self.orientation = orientation
+        self.outputs["eDP1"] = state._replace(orientation = orientation)
+        self.changed()
+
+    def set_matrix(self, device, matrix):
+        self.calls.append(("set_matrix", device, tuple(matrix)))
+        self.matrices[device] = tuple(matrix)
+        self.changed()
+
+    def set_area(self, device, area):
+        self.calls.append(("set_area", device, list(area)))
+        self.areas[device] = list(area)
+        self.changed()
+
+    def get_area(self, device):
+        return list(self.areas.get(device, self.default_area))
+
+    def set_enabled(self, device, enabled):
+        self.calls.append(("set_enabled", device, enabled))
+        self.enabled[device] = enabled
+        self.changed()
+
+    def list_devices(self):
+        return list(self.devices)
+
+    def watch_devices(self, callback):
+        raise IOError("The fake backend has no hotplug events")
+
+    def list_outputs(self):
+        return dict(self.outputs)
+
+    def watch_outputs(self, callback):
+        raise IOError("The fake backend has no RandR events")
+
+
+def open_backend(name = "auto"):
+    ''' Return the X backend called name, preferring xlib for "auto" '''
+    if name == "command":
+        return CommandBackend()
+    elif name == "fake":
+        return FakeBackend()
+    try:
+        backend = XlibBackend()
+        log.info("Using the python-xlib X backend")
+        return backend
+    except Exception as err:
+        if name == "xlib":
+            raise
+        log.info("Using the command line X backend: {0}".format(err))
+        return CommandBackend()
+
+
+class OrientationEngine():
+    '''
+    Incremental screen orientation detection from acceleration samples.
+
+    Samples are first turned into the frame of the screen by the mounting
+    matrix, as given by the kernel's mount_matrix attribute. Each sample
+    updates an exponential moving average, which is classified against the
+    unit gravity vectors of the four orientations with a single
+    matrix-vector product. When gravity is within flat degrees of the
+    screen's normal, as when it lies on a table, the orientation is
+    indeterminate and the candidate is "flat", which never rotates the
+    screen. A new orientation is only reported once it is closer than the
+    current one by at least hysteresis degrees, and has stayed so for dwell
+    seconds.
+    '''
+
+    def __init__(self, orientation = "normal", smoothing = 0.4, hysteresis = 10.0, dwell = 0.3,
+                 mounting = None, flat = 25.0):
+        self.orientation = orientation
+        self.smoothing = smoothing
+        self.hysteresis = hysteresis
+        self.dwell = dwell
+        self.flat = flat
+        self.mount(mounting)
+        self.average = None
+        self.candidate = None
+        self.candidate_since = None
+
+    def mount(self, mounting = None):
+        ''' Set the 3 x 3 matrix taking samples to the frame of the screen '''
+        from numpy import array, cos, eye, radians
+        if mounting is None:
+            mounting = eye(3)
+        self.mounting = array(mounting, dtype = float)
+        # Fold the mounting into the references, so raw samples are classified
+        # with one product: reference . (mounting . sample).
+        self.matrix = array(ORIENTATION_VECTORS).dot(self.mounting)
+        self.normal = array([0.0, 0.0, 1.0]).dot(self.mounting)
+        self.flat_cosine = cos(radians(self.flat))
+
+    def classify(self, vectors):
+        '''
+        Return the angles in degrees between each vector and each orientation,
+        for one vector or an n x 3 array of them. Angles of zero vectors are nan.
+        '''
+        from numpy import arccos, asarray, clip, degrees, errstate, newaxis
+        from numpy.linalg import norm
+        vectors = asarray(vectors, dtype = float)
+        magnitudes = norm(vectors, axis = -1)
+        with errstate(invalid = "ignore", divide = "ignore"):
+            cosines = vectors.dot(self.matrix.T) / magnitudes[..., newaxis]
+            return degrees(arccos(clip(cosines, -1.0, 1.0)))
+
+    def is_flat(self, vectors):
+        ''' Return whether each vector points along the normal of the screen '''
+        from numpy import absolute, asarray, errstate
+        from numpy.linalg import norm
+        vectors = asarray(vectors, dtype = float)
+        with errstate(invalid = "ignore", divide = "ignore"):
+            return absolute(vectors.dot(self.normal)) / norm(vectors, axis = -1) >= self.flat_cosine
+
+    def orientations(self, samples):
+        '''
+        Return the nearest orientation of each sample of an n x 3 array, or
+        "flat", or None for zero samples, classifying them all at once.
+        '''
+        from numpy import isnan
+        angles = self.classify(samples)
+        flat = self.is_flat(samples)
+        return [None if isnan(row).any() else "flat" if lying else ORIENTATIONS[row.argmin()]
+                for row, lying in zip(angles, flat)]
+
+    def update(self, sample, timestamp = None):
+        ''' Add a sample and return the new orientation if it changed, else None '''
+        from numpy import asarray, isnan
+        if timestamp is None:
+            timestamp = time.time()
+        sample = asarray(sample, dtype = float)
+        if self.average is None:
+            self.average = sample.copy()
+        else:
+            self.average += self.smoothing * (sample - self.average)
+        angles = self.classify(self.average)
+        if isnan(angles).any():
+            return None
+        if self.is_flat(self.average):
+            if self.candidate != "flat":
+                log.debug("Orientation indeterminate, lying flat at %s", self.average)
+                self.candidate = "flat"
+            return None
+        candidate = ORIENTATIONS[angles.argmin()]
+        current = angles[ORIENTATIONS.index(self.orientation)]
+        if candidate == self.orientation or current - angles.min() < self.hysteresis:
+            self.candidate = None
+            return None
+        if candidate != self.candidate:
+            log.debug("Orientation candidate %s at %s", candidate, self.average)
+            self.candidate = candidate
+            self.candidate_since = timestamp
+        if timestamp - self.candidate_since < self.dwell:
+            return None
+        self.orientation = candidate
+        self.candidate = None
+        return candidate
+
+
+def parse_mount_matrix(text):
+    ''' Return the 3 x 3 matrix of a mount_matrix such as "0, 1, 0; -1, 0, 0; 0, 0, 1" '''
+    rows = [[float(value) for value in row.split(",")] for row in text.strip().split(";")]
+    if len(rows) != 3 or any(len(row) != 3 for row in rows):
+        raise ValueError("A mount matrix has three rows of three values: {0}".format(text))
+    return rows
+
+
+def read_mount_matrix(directory):
+    ''' Return the mount matrix of the accelerometer in directory, or None if it has none '''
+    for name in ("in_accel_mount_matrix", "mount_matrix"):
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            with open(path) as matrix:
+                return parse_mount_matrix(matrix.read())
+    return None
+
+
+class AcpiEventParser():
+    '''
+    Split the acpid event stream into events.
+
+    Data is buffered until a whole line has arrived, so several events in
+    one read and events split across reads are both handled. Each line is
+    tokenised into (class, device, code, value); the class of some events is
+    empty.
+    '''
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, data):
+        ''' Return the events completed by data '''
+        self.buffer += data
+        lines = self.buffer.split("\n")
+        self.buffer = lines.pop()
+        return [parse_acpi_event(line) for line in lines if line.strip()]
+
+
+def parse_acpi_event(line):
+    ''' Return the (class, device, code, value) of an acpid event line '''
+    log.debug("ACPI event: %s", line)
+    fields = line.rstrip("\r").split(" ", 3)
+    return tuple(fields + [""] * (4 - len(fields)))
+
+
+def load_acpi_actions(path = ACPI_SETTINGS):
+    '''
+    Return the ACPI event to action table, extended by the JSON object in
+    path, if that file exists. Its keys are event lines and its values are
+    either a mode or a [mode, seconds to ignore repeats] pair. Entries with
+    an unknown mode are left out.
+    '''
+    actions = dict(ACPI_ACTIONS)
+    if os.path.exists(path):
+        try:
+            with open(path) as settings:
+                for line, action in json.load(settings).iteritems():
+                    if not isinstance(action, list):
+                        action = [action, 0.0]
+                    if action[0] not in MODES:
+                        log.error("Ignoring ACPI event {line} in {path}: unknown mode \"{mode}\"".format(
+                            line = line, path = path, mode = action[0]))
+                        continue
+                    actions[parse_acpi_event(str(line))] = (str(action[0]), float(action[1]))
+        except (IOError, ValueError, AttributeError, IndexError) as err:
+            log.error("Ignoring ACPI settings in {path}: {err}".format(path = path, err = err))
+    return actions
+
+
+class FakeAcpid():
+    '''
+    Local stand-in for the acpid socket, for replaying captured events.
+
+    Clients connecting to path receive whatever is sent or replayed.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(4)
+        self.clients = []
+        self.accepter = threading.Thread(target = self.accept, name = "spin-fake-acpid")
+        self.accepter.daemon = True
+        self.accepter.start()
+
+    def accept(self):
+        while True:
+            try:
+                client, address = self.server.accept()
+            except socket.error:
+                return
+            self.clients.append(client)
+
+    def wait_for_client(self, timeout = 5.0):
+        return wait_for(lambda: self.clients, timeout = timeout, interval = 0.01)
+
+    def send(self, data):
+        for client in list(self.clients):
+            client.sendall(data)
+
+    def replay(self, capture, interval = 0.0):
+        ''' Send the event lines of a capture file, interval seconds apart '''
+        with open(capture) as lines:
+            for line in lines:
+                self.send(line)
+                if interval:
+                    time.sleep(interval)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.server.close()
+        self.accepter.join(1.0)
+        os.remove(self.path)
+
+
+def find_accelerometer(root = IIO_DEVICES):
+    ''' Return the IIO device directory of the accelerometer under root '''
+    for directory in sorted(glob.glob(os.path.join(root, "iio:device*"))):
+        with open(os.path.join(directory, "name")) as name:
+            if "accel_3d" in name.read():
+                return directory
+    raise IOError("No accelerometer found in {root}".format(root = root))
+
+
+def read_attribute(fd, size = 32):
+    ''' Read a sysfs attribute from the start of an open file descriptor '''
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, 0)
+    os.lseek(fd, 0, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+class AccelerometerReader():
+    '''
+    Long-lived reader for the IIO accelerometer.
+
+    The device is looked up once and the x, y and z sysfs files stay open, so
+    each sample costs three reads. Pass another root to read a fake sysfs tree.
+    '''
+
+    paced = False
+
+    def __init__(self, root = IIO_DEVICES):
+        self.directory = find_accelerometer(root)
+        with open(os.path.join(self.directory, "in_accel_scale")) as scale:
+            self.scale = float(scale.read())
+        self.fds = [
+            os.open(os.path.join(self.directory, "in_accel_{0}_raw".format(axis)), os.O_RDONLY)
+            for axis in ("x", "y", "z")
+        ]
+
+    def read_raw(self, out):
+        ''' Read the unscaled x, y and z values into out '''
+        for axis, fd in enumerate(self.fds):
+            out[axis] = int(read_attribute(fd))
+
+    def read(self):
+        ''' Return one acceleration sample as a list of x, y and z '''
+        sample = [0, 0, 0]
+        self.read_raw(sample)
+        return [value * self.scale for value in sample]
+
+    def read_n(self, n, interval = 0.0, wake = None):
+        ''' Return n samples, interval seconds apart, as an n x 3 array; wake is unused '''
+        from numpy import empty
+        samples = empty((n, 3))
+        for sample in samples:
+            if interval:
+                time.sleep(interval)
+            self.read_raw(sample)
+        samples *= self.scale
+        return samples
+
+    def set_rate(self, rate):
+        ''' The rate of a polled reader is up to its caller, so return None '''
+        return None
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+IIOScanType = namedtuple("IIOScanType", ["endianness", "signed", "bits", "storagebits", "repeat", "shift"])
+
+
+def parse_iio_type(descriptor):
+    ''' Parse a scan element type descriptor such as "le:s12/16>>4" '''
+    match = re.match(r"^(be|le):(s|u)(\d+)/(\d+)(?:X(\d+))?>>(\d+)$", descriptor.strip())
+    if match is None:
+        raise ValueError("Unknown IIO scan element type \"{0}\"".format(descriptor.strip()))
+    endianness, sign, bits, storagebits, repeat, shift = match.groups()
+    return IIOScanType(
+        endianness  = endianness,
+        signed      = sign == "s",
+        bits        = int(bits),
+        storagebits = int(storagebits),
+        repeat      = int(repeat or 1),
+        shift       = int(shift)
+    )
+
+
+def iio_scan_dtype(elements):
+    '''
+    Return the NumPy structured dtype of one buffer frame.
+
+    elements is a list of (name, index, IIOScanType) for the enabled scan
+    elements. Each element is stored in index order, aligned to its own
+    storage size, and the frame is padded to the largest storage size.
+    '''
+    from numpy import dtype
+    names, formats, offsets = [], [], []
+    offset = 0
+    alignment = 1
+    for name, index, scan_type in sorted(elements, key = lambda element: element[1]):
+        size = scan_type.storagebits // 8
+        offset += -offset % size
+        names.append(name)
+        element_format = "{endian}{kind}{size}".format(
+            endian = "<" if scan_type.endianness == "le" else ">",
+            kind   = "i" if scan_type.signed else "u",
+            size   = size
+        )
+        if scan_type.repeat > 1:
+            element_format = (element_format, (scan_type.repeat,))
+        formats.append(element_format)
+        offsets.append(offset)
+        offset += size * scan_type.repeat
+        alignment = max(alignment, size)
+    offset += -offset % alignment
+    return dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": offset})
+
+
+class IIOBufferDecoder():
+    '''
+    Decode packed IIO buffer frames into scaled x, y and z accelerations.
+
+    The decoder only needs the scan element descriptors and the scale, so a
+    recorded capture of /dev/iio:deviceN can be decoded with decode_file().
+    '''
+
+    axes = ("in_accel_x", "in_accel_y", "in_accel_z")
+
+    def __init__(self, elements, scale):
+        self.types = dict((name, scan_type) for name, index, scan_type in elements)
+        for axis in self.axes:
+            if axis not in self.types:
+                raise ValueError("Scan element {0} is not enabled".format(axis))
+        self.dtype = iio_scan_dtype(elements)
+        self.scale = scale
+
+    @classmethod
+    def from_scan_elements(cls, directory, scale):
+        ''' Build a decoder from the enabled elements in a scan_elements directory '''
+        elements = []
+        for enable in glob.glob(os.path.join(directory, "*_en")):
+            with open(enable) as enabled:
+                if enabled.read().strip() != "1":
+                    continue
+            name = os.path.basename(enable)[:-len("_en")]
+            with open(os.path.join(directory, name + "_index")) as index:
+                index = int(index.read())
+            with open(os.path.join(directory, name + "_type")) as scan_type:
+                scan_type = parse_iio_type(scan_type.read())
+            elements.append((name, index, scan_type))
+        return cls(elements, scale)
+
+    def decode(self, data):
+        ''' Return the complete frames in data as an n x 3 array '''
+        from numpy import empty, frombuffer, int64, where
+        count = len(data) // self.dtype.itemsize
+        frames = frombuffer(data, dtype = self.dtype, count = count)
+        samples = empty((count, 3))
+        for column, axis in enumerate(self.axes):
+            scan_type = self.types[axis]
+            values = frames[axis].astype(int64) >> scan_type.shift
+            values &= (1 << scan_type.bits) - 1
+            if scan_type.signed:
+                sign = 1 << (scan_type.bits - 1)
+                values = where(values >= sign, values - (sign << 1), values)
+            samples[:, column] = values
+        samples *= self.scale
+        return samples
+
+    def decode_file(self, path):
+        ''' Decode a recorded binary capture of the buffer '''
+        with open(path, "rb") as capture:
+            return self.decode(capture.read())
+
+
+def write_attribute(path, value):
+    with open(path, "w") as attribute:
+        attribute.write(str(value))
+
+
+class IIOBufferReader():
+    '''
+    Triggered buffer capture from the accelerometer.
+
+    Enables the x, y and z scan elements and the IIO buffer, then reads whole
+    sample frames in bulk from the /dev/iio:deviceN character device, so the
+    device's own sampling clock sets the timing. Raises IOError or OSError
+    when buffered capture is not available.
+    '''
+
+    paced = True
+
+    def __init__(self, root = IIO_DEVICES, chardevs = IIO_CHARDEVS, length = 64):
+        self.directory = find_accelerometer(root)
+        scan_elements = os.path.join(self.directory, "scan_elements")
+        self.enable_path = os.path.join(self.directory, "buffer", "enable")
+        chardev = os.path.join(chardevs, os.path.basename(self.directory))
+        if not os.path.isdir(scan_elements) or \
+           not os.access(self.enable_path, os.W_OK) or \
+           not os.access(chardev, os.R_OK):
+            raise IOError("Buffered capture is not available for {0}".format(self.directory))
+        with open(os.path.join(self.directory, "in_accel_scale")) as scale:
+            scale = float(scale.read())
+        self.set_trigger(root)
+        opened = False
+        try:
+            write_attribute(self.enable_path, 0)
+            for axis in ("x", "y", "z"):
+                write_attribute(os.path.join(scan_elements, "in_accel_{0}_en".format(axis)), 1)
+            write_attribute(os.path.join(self.directory, "buffer", "length"), length)
+            self.decoder = IIOBufferDecoder.from_scan_elements(scan_elements, scale)
+            write_attribute(self.enable_path, 1)
+            self.fd = os.open(chardev, os.O_RDONLY)
+            opened = True
+        finally:
+            if not opened:
+                # Many drivers refuse sysfs reads, as the fallback does,
+                # while the buffer is enabled.
+                write_attribute(self.enable_path, 0)
+
+    def set_trigger(self, root):
+        ''' Select the accelerometer's own trigger if none is selected '''
+        current_trigger = os.path.join(self.directory, "trigger", "current_trigger")
+        if not os.path.exists(current_trigger):
+            return
+        with open(current_trigger) as trigger:
+            if trigger.read().strip():
+                return
+        for directory in glob.glob(os.path.join(root, "trigger*")):
+            with open(os.path.join(directory, "name")) as name:
+                name = name.read().strip()
+            if name.startswith("accel_3d"):
+                write_attribute(current_trigger, name)
+                return
+        raise IOError("No trigger available for {0}".format(self.directory))
+
+    def read(self):
+        ''' Return one acceleration sample as a list of x, y and z '''
+        return self.read_n(1)[0].tolist()
+
+    def read_n(self, n, interval = None, wake = None):
+        '''
+        Return the next n samples as an n x 3 array, or None if the file
+        descriptor wake becomes readable first; interval is unused.
+        '''
+        size = n * self.decoder.dtype.itemsize
+        data = b""
+        while len(data) < size:
+            if wake is not None:
+                try:
+                    readable = select.select([self.fd, wake], [], [])[0]
+                except select.error as err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if wake in readable:
+                    return None
+            chunk = os.read(self.fd, size - len(data))
+            if not chunk:
+                raise IOError("Accelerometer buffer closed")
+            data += chunk
+        return self.decoder.decode(data)
+
+    def set_rate(self, rate):
+        '''
+        Ask the device for rate samples per second, and return the rate it
+        samples at, or None if it has no sampling frequency to set or read.
+        '''
+        path = os.path.join(self.directory, "in_accel_sampling_frequency")
+        try:
+            write_attribute(path, "{0:g}".format(rate))
+        except (IOError, OSError) as err:
+            log.debug("Unable to set the accelerometer sampling frequency: %s", err)
+        try:
+            with open(path) as frequency:
+                return float(frequency.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def close(self):
+        os.close(self.fd)
+        write_attribute(self.enable_path, 0)
+
+
+def open_accelerometer(root = IIO_DEVICES, chardevs = IIO_CHARDEVS):
+    ''' Return a buffered accelerometer reader if possible, else a sysfs one '''
+    try:
+        reader = IIOBufferReader(root, chardevs)
+        log.info("Reading the accelerometer through the IIO buffer")
+        return reader
+    except (IOError, OSError, ValueError) as err:
+        log.debug("Falling back to sysfs accelerometer reads: {0}".format(err))
+        return AccelerometerReader(root)
+
+
+def send_command(commands, path = SPIN_SOCKET, timeout = 5.0):
+    ''' Send one or more commands to the daemon, and return its response '''
+    if isinstance(commands, basestring):
+        commands = [commands]
+    if not os.path.exists(path):
         log.error("Socket does not exist. Is the spin deamon running.")
+        return None
+    request = {"version": PROTOCOL_VERSION, "id": os.getpid(), "commands": commands}
+    command_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    command_socket.settimeout(timeout)
+    try:
+        command_socket.connect(path)
+        command_socket.sendall(json.dumps(request) + "\n")
+        response = json.loads(command_socket.makefile().readline())
+    except (socket.error, ValueError) as err:
+        log.error("Failed to send {commands} to the spin daemon: {err}".format(
+            commands = ", ".join(commands),
+            err      = err
+        ))
+        return None
+    finally:
+        command_socket.close()
+    if "error" in response:
+        log.error("The spin daemon refused the request: {0}".format(response["error"]))
+    for result in response.get("results", []):
+        if result["ok"]:
+            log.info("The spin daemon did {command} in {elapsed:.1f} ms".format(
+                command = result["command"],
+                elapsed = result["elapsed"] * 1000
+            ))
+        else:
+            log.error("The spin daemon failed to {command}: {error}".format(
+                command = result["command"],
+                error   = result["error"]
+            ))
+    return response
+
+
+def watch_events(path = SPIN_SOCKET):
+    ''' Print the daemon status, then every event it publishes as a line of JSON '''
+    if not os.path.exists(path):
+        log.error("Socket does not exist. Is the spin deamon running.")
+        return
+    request = {"version": PROTOCOL_VERSION, "id": os.getpid(), "commands": ["subscribe", "status"]}
+    command_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        command_socket.connect(path)
+        command_socket.sendall(json.dumps(request) + "\n")
+        lines = command_socket.makefile()
+        response = json.loads(lines.readline())
+        print(json.dumps(response["results"][1]["status"], sort_keys = True))
+        sys.stdout.flush()
+        for line in iter(lines.readline, ""):
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    except (socket.error, ValueError, KeyError, IndexError) as err:
+        log.error("Failed to watch the spin daemon: {0}".format(err))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        command_socket.close()
+
+
+def benchmark_startup(runs = 10):
+    ''' Print the start-up time of each client command '''
+    # Commands go to a socket nobody listens on, so no daemon is disturbed.
+    spin_socket = os.path.join(tempfile.mkdtemp(), "benchmark.socket")
+    with open(os.devnull, "w") as devnull:
+        for option in ["--version", "--mode", "--rotatelock", "--toggletouch"]:
+            times = []
+            for run in range(runs):
+                start = time.time()
+                subprocess.call(
+                    [sys.executable, os.path.abspath(__file__), option, "--socket", spin_socket],
+                    stdout = devnull,
+                    stderr = devnull
+                )
+                times.append(time.time() - start)
+            print("{option:15} min {min:6.1f} ms  mean {mean:6.1f} ms".format(
+                option = option,
+                min    = min(times) * 1000,
+                mean   = sum(times) / len(times) * 1000
+            ))
+    os.rmdir(os.path.dirname(spin_socket))
+
+
+def make_fake_accelerometer(root, scale = 0.001):
+    ''' Create the sysfs files of an accelerometer under root, and return its directory '''
+    directory = os.path.join(root, "iio:device0")
+    os.makedirs(directory)
+    write_attribute(os.path.join(directory, "name"), "accel_3d\n")
+    write_attribute(os.path.join(directory, "in_accel_scale"), "{0}\n".format(scale))
+    set_fake_acceleration(directory, [0.0, -9.81, 0.0], scale)
+    return directory
+
+
+def set_fake_acceleration(directory, sample, scale = 0.001):
+    ''' Set the x, y and z values a fake accelerometer reads '''
+    for axis, value in zip(("x", "y", "z"), sample):
+        path = os.path.join(directory, "in_accel_{0}_raw".format(axis))
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+        try:
+            # Overwrite in place and padded, never truncating, so a reader
+            # holding the file open never sees it empty.
+            os.write(fd, str(int(round(value / scale))).ljust(15) + "\n")
+        finally:
+            os.close(fd)
+
+
+class ReplayHarness():
+    '''
+    Run a daemon against fakes, and feed it captured or scripted inputs.
+
+    The inputs are (seconds, source, value) tuples as returned by
+    load_capture(). Accelerometer samples are written to a fake sysfs tree,
+    ACPI data is sent by a FakeAcpid, stylus proximity is posted to the
+    sensor channel and commands go through the control socket. X changes and
+    shell commands are recorded by a FakeBackend. The inputs are replayed
+    speed times as fast as they were recorded; pass float("inf") to send
+    them as fast as possible. After the last input, the harness waits
+    settle seconds, and then for the action worker to finish.
+    '''
+
+    def __init__(self, inputs, speed = 1.0, settle = 1.0, devices = None):
+        self.inputs = sorted(inputs, key = lambda event: event[0])
+        self.speed = speed
+        self.settle = settle
+        if devices is None:
+            devices = [phrases[0] for phrases in DEVICE_KEYPHRASES.itervalues()]
+        self.devices = devices
+
+    def run(self):
+        ''' Replay the inputs, and return what it cost '''
+        from PyQt4 import QtCore
+        app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication(sys.argv)
+        directory = tempfile.mkdtemp(prefix = "spin-replay-")
+        measuring = latency.enabled
+        try:
+            accelerometer = make_fake_accelerometer(directory)
+            acpid = FakeAcpid(os.path.join(directory, "acpid.socket"))
+            backend = FakeBackend(self.devices)
+            self.spin_socket = os.path.join(directory, "spin.socket")
+            daemon = Daemon(
+                backend      = backend,
+                acpi_socket  = acpid.path,
+                acpi_actions = dict(ACPI_ACTIONS),
+                spin_socket  = self.spin_socket,
+                settings     = os.path.join(directory, "spin.conf"),
+                iio_root     = directory,
+                iio_chardevs = directory,
+                sense_stylus = False
+            )
+            acpid.wait_for_client()
+            done = os.pipe()
+            daemon.watch(done[0], app.quit)
+            latency.enabled = True
+            latency.reset()
+            calls = len(backend.calls)
+            flushes = backend.flushes
+            wakeups = daemon.wakeups
+            syscalls = io_syscalls()
+            started = time.time()
+            feeder = threading.Thread(
+                target = self.feed,
+                args   = (daemon, acpid, accelerometer, done[1]),
+                name   = "spin-replay"
+            )
+            feeder.daemon = True
+            feeder.start()
+            app.exec_()
+            elapsed = time.time() - started - self.settle
+            if syscalls is not None:
+                syscalls = io_syscalls() - syscalls
+            feeder.join()
+            daemon.unwatch(done[0])
+            for fd in done:
+                os.close(fd)
+            calls = backend.calls[calls:]
+            result = {
+                "inputs":   len(self.inputs),
+                "elapsed":  elapsed,
+                "rate":     len(self.inputs) / elapsed,
+                "decision": percentiles(latency.durations("requested to applied") +
+                                        latency.durations("requested to engaged")),
+                "x_calls":  len([call for call in calls if call[0] != "run"]),
+                "commands": len([call for call in calls if call[0] == "run"]),
+                "flushes":  backend.flushes - flushes,
+                "wakeups":  daemon.wakeups - wakeups,
+                "syscalls": syscalls,
+                "state":    daemon.state()
+            }
+            daemon.close_event(None)
+            acpid.close()
+            return result
+        finally:
+            latency.enabled = measuring
+            shutil.rmtree(directory, ignore_errors = True)
+
+    def feed(self, daemon, acpid, accelerometer, done):
+        started = time.time()
+        for seconds, source, value in self.inputs:
+            delay = started + seconds / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if source == "accel":
+                set_fake_acceleration(accelerometer, value)
+            elif source == "acpi":
+                acpid.send(str(value))
+            elif source == "stylus":
+                daemon.sensor_channel.put("stylus", str(value))
+            elif source == "command":
+                send_command(str(value), self.spin_socket)
+            elif source in ["candidate", "orientation", "engage"]:
+                # Decisions in a trace, which the replay makes anew.
+                pass
+            else:
+                log.error("Unknown replay input {0}".format(source))
+        # Let the last inputs through the sensors, the debounce and the
+        # action worker, which runs its jobs in order.
+        time.sleep(self.settle)
+        wait_for(lambda: not daemon.reconciler.pending)
+        settled = threading.Event()
+        daemon.action_worker.submit("replay end", [settled.set])
+        settled.wait(30.0)
+        os.write(done, "x")
+
+
+def benchmark_scenarios():
+    ''' Return the (name, inputs, speed) of the scripted benchmark scenarios '''
+    gravity = dict((orientation, [9.81 * value for value in vector])
+                   for orientation, vector in zip(ORIENTATIONS, ORIENTATION_VECTORS))
+    # Tilt the screen through every orientation, sampled at 20 Hz.
+    rotation = [(0.0, "command", "tablet")]
+    for turn, orientation in enumerate(["left", "inverted", "right", "normal"]):
+        rotation += [(0.1 + turn + sample * 0.05, "accel", gravity[orientation])
+                     for sample in range(20)]
+    # Press the rotation lock key, which acpid reports twice, and the tablet switch.
+    lock, tablet = [[event for event in sorted(ACPI_ACTIONS) if ACPI_ACTIONS[event][0] == mode][0]
+                    for mode in ("togglelock", "toggle")]
+    acpi = []
+    for press in range(5):
+        acpi += [(press * 0.6,        "acpi", " ".join(lock) + "\n"),
+                 (press * 0.6 + 0.01, "acpi", " ".join(lock) + "\n"),
+                 (press * 0.6 + 0.3,  "acpi", " ".join(tablet) + "\n")]
+    # Hover the pen in and out of range.
+    stylus = [(step * 0.05, "stylus", ["in", "out"][step % 2]) for step in range(40)]
+    # Script the daemon through its control socket.
+    commands = [(step * 0.02, "command", command) for step, command in
+                enumerate(["tablet", "left", "togglelock", "inverted", "toggletouch", "laptop"] * 5)]
+    # The accelerometer is sampled, and repeated ACPI events are ignored,
+    # in real time, so only the stylus and commands can be sent flat out.
+    return [
+        ("rotation", rotation, 1.0),
+        ("acpi",     acpi,     1.0),
+        ("stylus",   stylus,   float("inf")),
+        ("commands", commands, float("inf"))
+    ]
+
+
+def benchmark_replay():
+    ''' Print what handling each benchmark scenario costs the daemon '''
+    for name, inputs, speed in benchmark_scenarios():
+        result = ReplayHarness(inputs, speed = speed).run()
+        decision = result["decision"]
+        print("{name:15} {inputs:4} inputs {rate:7.1f}/s  decision p50 {p50:6.1f} ms  p95 {p95:6.1f} ms  "
+              "max {max:6.1f} ms  X calls {x_calls:4}  flushes {flushes:4}  commands {commands:4}  "
+              "wakeups {wakeups:5}  syscalls {syscalls}".format(
+            name     = name,
+            inputs   = result["inputs"],
+            rate     = result["rate"],
+            p50      = (decision["p50"] or 0) * 1000,
+            p95      = (decision["p95"] or 0) * 1000,
+            max      = (decision["max"] or 0) * 1000,
+            x_calls  = result["x_calls"],
+            flushes  = result["flushes"],
+            commands = result["commands"],
+            wakeups  = result["wakeups"],
+            syscalls = result["syscalls"]
+        ))
 
 
 def main():
@@ -720,6 +3539,58 @@ def main():
     parser.add_argument("-x", "--reset",
                         help="Reset the Wacom pen calibration for the current screen orientation",
                         action="store_true")
+    parser.add_argument("--hysteresis",
+                        help="Degrees by which a new screen orientation must be closer than the current one",
+                        type=float,
+                        default=10.0)
+    parser.add_argument("--dwell",
+                        help="Seconds a new screen orientation must be held before rotating",
+                        type=float,
+                        default=0.3)
+    parser.add_argument("--mount-matrix",
+                        help="How the accelerometer is mounted, as \"x1, y1, z1; x2, y2, z2; x3, y3, z3\" (default: as the kernel reports, or upright)",
+                        type=parse_mount_matrix,
+                        default=None)
+    parser.add_argument("--flat",
+                        help="Degrees within which gravity must point through the screen for it to count as lying flat, which never rotates it",
+                        type=float,
+                        default=25.0)
+    parser.add_argument("--palm-grace",
+                        help="Seconds the touchscreen stays off after the pen leaves it",
+                        type=float,
+                        default=0.5)
+    parser.add_argument("--backend",
+                        help="How to change X settings: xlib, command or auto (xlib if available)",
+                        choices=["auto", "xlib", "command"],
+                        default="auto")
+    parser.add_argument("--socket",
+                        help="Path of the socket the daemon listens to commands on",
+                        default=SPIN_SOCKET)
+    parser.add_argument("-s", "--status",
+                        help="Print the state of the daemon and the devices it uses",
+                        action="store_true")
+    parser.add_argument("-w", "--watch",
+                        help="Print the state of the daemon, then each change of it as it happens",
+                        action="store_true")
+    parser.add_argument("--latency",
+                        help="With --daemon, time each stage of handling sensors and commands; otherwise print those timings",
+                        action="store_true")
+    parser.add_argument("--record",
+                        help="With --daemon, record the sensor, ACPI and command inputs to a capture file",
+                        metavar="CAPTURE")
+    parser.add_argument("--trace",
+                        help="With --daemon, keep the latest sensor samples and decisions, and write them to a capture file on SIGUSR2 or a crash",
+                        metavar="CAPTURE")
+    parser.add_argument("--replay",
+                        help="Run a daemon against fake devices, feed it a capture file and print what it cost",
+                        metavar="CAPTURE")
+    parser.add_argument("--speed",
+                        help="How many times faster than recorded to replay a capture",
+                        type=float,
+                        default=1.0)
+    parser.add_argument("--benchmark",
+                        help="Print the start-up time of each client command, and the cost of scripted scenarios",
+                        action="store_true")
     parser.add_argument("-l", "--loglevel",
                         help="Log level (1=debug, 2=info, 3=warning, 4=error, 5=critical)",
                         type=int,
@@ -732,18 +3603,50 @@ def main():
         print(version)
     elif args.daemon:
         log.info("Starting Yoga Spin background daemon")
+        from PyQt4 import QtCore
         app = QtCore.QCoreApplication(sys.argv)
-        daemon = Daemon()
+        latency.enabled = args.latency
+        if args.record:
+            recorder.open(args.record)
+        if args.trace:
+            trace.open(args.trace)
+            def excepthook(*info):
+                trace.dump()
+                sys.__excepthook__(*info)
+            sys.excepthook = excepthook
+        daemon = Daemon(hysteresis  = args.hysteresis,
+                        dwell       = args.dwell,
+                        backend     = open_backend(args.backend),
+                        spin_socket = args.socket,
+                        mounting    = args.mount_matrix,
+                        flat        = args.flat,
+                        palm_grace  = args.palm_grace)
         sys.exit(app.exec_())
     elif args.mode:
         log.info("Toggle between tablet and laptop mode")
-        send_command("toggle")
+        send_command("toggle", args.socket)
     elif args.rotatelock:
         log.info("Toggle the rotation lock on/off")
-        send_command("togglelock")
+        send_command("togglelock", args.socket)
     elif args.toggletouch:
         log.info("Togge touch screen on/off")
-        send_command("toggletouch")
+        send_command("toggletouch", args.socket)
+    elif args.status:
+        response = send_command("status", args.socket)
+        if response is not None and response["ok"]:
+            print(json.dumps(response["results"][0]["status"], indent = 4, sort_keys = True))
+    elif args.latency:
+        response = send_command("latency", args.socket)
+        if response is not None and response["ok"]:
+            print(json.dumps(response["results"][0]["latency"], indent = 4, sort_keys = True))
+    elif args.watch:
+        watch_events(args.socket)
+    elif args.replay:
+        result = ReplayHarness(load_capture(args.replay), speed = args.speed).run()
+        print(json.dumps(result, indent = 4, sort_keys = True))
+    elif args.benchmark:
+        benchmark_startup()
+        benchmark_replay()
     elif args.calibrate:
         log.info("Calibrating the Wacom pen")
         cal = Calibration('Wacom ISDv4 EC Pen stylus')
@@ -0,0 +1,759 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+'''
+Tests of spin.py that need neither X, nor an accelerometer, nor acpid.
+
+Run them with "python -m unittest test_spin".
+'''
+
+import os
+import errno
+import json
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import logging
+import unittest
+
+import spin
+
+spin.log = logging.getLogger()
+
+
+def apply_matrix(matrix, x, y):
+    ''' Map the normalised device coordinates x, y through a row order matrix '''
+    return (matrix[0] * x + matrix[1] * y + matrix[2],
+            matrix[3] * x + matrix[4] * y + matrix[5])
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = "spin-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+
+class OutputMatrixTest(unittest.TestCase):
+
+    def assertMatrixEqual(self, first, second):
+        self.assertEqual(len(first), 9)
+        for a, b in zip(first, second):
+            self.assertAlmostEqual(a, b)
+
+    def test_single_screen_matches_rotations(self):
+        for orientation, rotation in spin.TOUCHSCREEN_MATRICES.items():
+            self.assertMatrixEqual(spin.output_matrix(orientation, (0, 0, 1920, 1080), (1920, 1080)), rotation)
+
+    def test_unrotated_pen_on_single_screen_is_identity(self):
+        self.assertMatrixEqual(spin.output_matrix(None, (0, 0, 1920, 1080), (1920, 1080)),
+                               spin.TOUCHSCREEN_MATRICES["normal"])
+
+    def test_offset_output(self):
+        # A 1920x1080 panel right of a 2560x1440 monitor.
+        matrix = spin.output_matrix("normal", (2560, 0, 1920, 1080), (4480, 1440))
+        self.assertMatrixEqual(matrix, (1920.0 / 4480, 0, 2560.0 / 4480, 0, 1080.0 / 1440, 0, 0, 0, 1))
+        x, y = apply_matrix(matrix, 1, 1)
+        self.assertAlmostEqual(x, 1.0)
+        self.assertAlmostEqual(y, 1080.0 / 1440)
+
+    def test_rotated_output_beside_another(self):
+        # A 1920x1080 panel turned left, right of a 1920x1080 monitor.
+        matrix = spin.output_matrix("left", (1920, 0, 1080, 1920), (3000, 1920))
+        left = 1920.0 / 3000
+        for device, screen in [((0, 0), (1.0, 0.0)),
+                               ((1, 0), (1.0, 1.0)),
+                               ((0, 1), (left, 0.0)),
+                               ((1, 1), (left, 1.0))]:
+            x, y = apply_matrix(matrix, *device)
+            self.assertAlmostEqual(x, screen[0])
+            self.assertAlmostEqual(y, screen[1])
+
+    def test_transforms_are_memoized_by_layout(self):
+        transforms = spin.InputTransforms()
+        matrix = transforms.matrix("left", (0, 0, 1080, 1920), (1080, 1920))
+        self.assertIs(transforms.matrix("left", [0, 0, 1080, 1920], [1080, 1920]), matrix)
+        self.assertIsNot(transforms.matrix("left", (0, 0, 1080, 1920), (3000, 1920)), matrix)
+        self.assertEqual(len(transforms.matrices), 2)
+
+
+class FakeSysfsReaderTest(TemporaryDirectoryTestCase):
+
+    def test_reads_scaled_samples(self):
+        accelerometer = spin.make_fake_accelerometer(self.directory)
+        reader = spin.AccelerometerReader(self.directory)
+        try:
+            for sample in [[0.0, -9.81, 0.0], [9.81, 0.0, -1.5]]:
+                spin.set_fake_acceleration(accelerometer, sample)
+                for value, expected in zip(reader.read(), sample):
+                    self.assertAlmostEqual(value, expected)
+            samples = reader.read_n(2)
+            self.assertEqual(samples.shape, (2, 3))
+            self.assertAlmostEqual(samples[1][2], -1.5)
+        finally:
+            reader.close()
+
+    def test_missing_accelerometer(self):
+        self.assertRaises((IOError, OSError), spin.AccelerometerReader, self.directory)
+
+
+class IIOBufferDecoderTest(TemporaryDirectoryTestCase):
+
+    def write_scan_elements(self, elements):
+        directory = os.path.join(self.directory, "scan_elements")
+        os.makedirs(directory)
+        for name, (index, descriptor, enabled) in elements.items():
+            spin.write_attribute(os.path.join(directory, name + "_en"), int(enabled))
+            spin.write_attribute(os.path.join(directory, name + "_index"), index)
+            spin.write_attribute(os.path.join(directory, name + "_type"), descriptor)
+        return directory
+
+    def test_decode_file(self):
+        scan_elements = self.write_scan_elements({
+            "in_accel_x":  (0, "le:s12/16>>4", True),
+            "in_accel_y":  (1, "le:s12/16>>4", True),
+            "in_accel_z":  (2, "le:s12/16>>4", True),
+            "in_timestamp": (3, "le:s64/64>>0", True),
+            "in_accel_w":  (4, "le:s16/16>>0", False)
+        })
+        decoder = spin.IIOBufferDecoder.from_scan_elements(scan_elements, 0.5)
+        # Three 16 bit axes, padded to the 64 bit timestamp.
+        self.assertEqual(decoder.dtype.itemsize, 16)
+        frames = [(100, -981, 0), (-2048, 2047, -1)]
+        capture = os.path.join(self.directory, "capture.bin")
+        with open(capture, "wb") as output:
+            for frame in frames:
+                output.write(struct.pack("<3h2xq", *([value << 4 for value in frame] + [123456789])))
+            # An incomplete frame at the end is left out.
+            output.write(b"\x00" * 5)
+        samples = decoder.decode_file(capture)
+        self.assertEqual(samples.shape, (2, 3))
+        for sample, frame in zip(samples, frames):
+            self.assertEqual(list(sample), [value * 0.5 for value in frame])
+
+    def test_missing_axis(self):
+        scan_elements = self.write_scan_elements({
+            "in_accel_x": (0, "le:s16/16>>0", True),
+            "in_accel_y": (1, "le:s16/16>>0", True)
+        })
+        self.assertRaises(ValueError, spin.IIOBufferDecoder.from_scan_elements, scan_elements, 1.0)
+
+
+class IIOBufferReaderTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super(IIOBufferReaderTest, self).setUp()
+        self.root = os.path.join(self.directory, "devices")
+        self.chardevs = os.path.join(self.directory, "dev")
+        self.accelerometer = spin.make_fake_accelerometer(self.root, scale = 0.5)
+        scan_elements = os.path.join(self.accelerometer, "scan_elements")
+        os.makedirs(scan_elements)
+        for index, axis in enumerate(("x", "y", "z")):
+            spin.write_attribute(os.path.join(scan_elements, "in_accel_{0}_en".format(axis)), 0)
+            spin.write_attribute(os.path.join(scan_elements, "in_accel_{0}_index".format(axis)), index)
+            spin.write_attribute(os.path.join(scan_elements, "in_accel_{0}_type".format(axis)), "le:s16/16>>0")
+        os.makedirs(os.path.join(self.accelerometer, "buffer"))
+        self.enable = os.path.join(self.accelerometer, "buffer", "enable")
+        spin.write_attribute(self.enable, 0)
+        spin.write_attribute(os.path.join(self.accelerometer, "buffer", "length"), 2)
+        os.makedirs(self.chardevs)
+        self.chardev = os.path.join(self.chardevs, "iio:device0")
+
+    def enabled(self):
+        with open(self.enable) as enable:
+            return enable.read()
+
+    def test_reads_frames_from_the_character_device(self):
+        with open(self.chardev, "wb") as chardev:
+            chardev.write(struct.pack("<6h", 2, -20, 0, 20, 0, -2))
+        reader = spin.IIOBufferReader(self.root, self.chardevs)
+        self.assertEqual(self.enabled(), "1")
+        self.assertEqual(reader.read(), [1.0, -10.0, 0.0])
+        self.assertEqual(reader.read_n(1).tolist(), [[10.0, 0.0, -1.0]])
+        reader.close()
+        self.assertEqual(self.enabled(), "0")
+
+    def test_buffer_is_disabled_when_the_device_cannot_be_opened(self):
+        # Opening a socket fails with ENXIO, as a busy device fails with EBUSY.
+        busy = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        busy.bind(self.chardev)
+        try:
+            self.assertRaises(OSError, spin.IIOBufferReader, self.root, self.chardevs)
+            self.assertEqual(self.enabled(), "0")
+            reader = spin.open_accelerometer(self.root, self.chardevs)
+            self.assertIsInstance(reader, spin.AccelerometerReader)
+            reader.close()
+        finally:
+            busy.close()
+
+
+class PalmRejectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.switched = []
+        self.slow = None
+        self.palm = spin.PalmRejection(self.switch, grace = 0.05)
+
+    def tearDown(self):
+        self.palm.stop()
+
+    def switch(self, enabled):
+        if enabled and self.slow is not None:
+            self.slow.wait(5.0)
+        self.switched.append(enabled)
+
+    def test_pen_turns_touch_off_until_the_grace_ends(self):
+        self.palm.pen("in")
+        self.assertEqual((self.palm.state, self.switched), ("pen", [False]))
+        self.palm.pen("out")
+        self.assertEqual((self.palm.state, self.switched), ("grace", [False]))
+        self.assertTrue(spin.wait_for(lambda: self.palm.state == "touch", 2.0, 0.01))
+        self.assertTrue(spin.wait_for(lambda: self.switched == [False, True], 2.0, 0.01))
+
+    def test_pen_returning_cancels_the_grace(self):
+        self.palm.grace = 0.2
+        self.palm.pen("in")
+        self.palm.pen("out")
+        self.palm.pen("in")
+        time.sleep(0.3)
+        self.assertEqual((self.palm.state, self.switched), ("pen", [False]))
+
+    def test_touch_disabled_altogether_is_left_alone(self):
+        self.palm.enable(False)
+        self.palm.pen("in")
+        self.palm.pen("out")
+        self.assertEqual((self.palm.state, self.switched), ("off", []))
+        self.palm.enable(True)
+        self.palm.pen("in")
+        self.palm.stop()
+        self.assertEqual((self.palm.state, self.switched), ("touch", [False, True]))
+
+    def test_slow_switch_does_not_hold_the_pen_up(self):
+        self.slow = threading.Event()
+        self.palm.pen("in")
+        self.palm.pen("out")
+        # The grace ends, and touch is being switched back on slowly.
+        self.assertTrue(spin.wait_for(lambda: self.palm.state == "touch", 2.0, 0.01))
+        pen = threading.Thread(target = self.palm.pen, args = ["in"])
+        pen.start()
+        pen.join(1.0)
+        alive = pen.is_alive()
+        self.slow.set()
+        pen.join()
+        self.assertFalse(alive)
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join(1.0)
+        # Touch ends up off, although switching it on finished last.
+        self.assertEqual(self.palm.state, "pen")
+        self.assertEqual(self.switched, [False, False, True, False])
+
+
+class OrientationEngineTest(unittest.TestCase):
+
+    gravity = dict((orientation, [9.81 * value for value in vector])
+                   for orientation, vector in zip(spin.ORIENTATIONS, spin.ORIENTATION_VECTORS))
+
+    def feed(self, engine, samples, start = 0.0, rate = 20.0):
+        ''' Feed samples at rate Hz, returning the orientations engine reported '''
+        changes = []
+        for step, sample in enumerate(samples):
+            orientation = engine.update(sample, start + step / rate)
+            if orientation is not None:
+                changes.append((start + step / rate, orientation))
+        return changes
+
+    def test_rotates_after_dwell(self):
+        engine = spin.OrientationEngine(dwell = 0.3)
+        changes = self.feed(engine, [self.gravity["left"]] * 20)
+        self.assertEqual([orientation for seconds, orientation in changes], ["left"])
+        self.assertGreaterEqual(changes[0][0], 0.3)
+        self.assertEqual(engine.orientation, "left")
+
+    def test_ignores_short_jolts(self):
+        engine = spin.OrientationEngine(dwell = 0.3)
+        samples = [self.gravity["normal"]] * 10 + [self.gravity["right"]] * 3 + [self.gravity["normal"]] * 20
+        self.assertEqual(self.feed(engine, samples), [])
+
+    def test_hysteresis_between_orientations(self):
+        # 50 degrees from normal towards right is closer to right, but only by 10 degrees.
+        engine = spin.OrientationEngine(hysteresis = 30.0, dwell = 0.0)
+        tilted = [-9.81 * 0.766, -9.81 * 0.643, 0.0]
+        self.assertEqual(self.feed(engine, [tilted] * 20), [])
+        engine = spin.OrientationEngine(hysteresis = 5.0, dwell = 0.0)
+        self.assertEqual([orientation for seconds, orientation in self.feed(engine, [tilted] * 20)], ["right"])
+
+    def test_lying_flat_never_rotates(self):
+        engine = spin.OrientationEngine(dwell = 0.0)
+        changes = self.feed(engine, [[0.5, 0.3, -9.8]] * 20)
+        self.assertEqual(changes, [])
+        self.assertEqual(engine.candidate, "flat")
+
+    def test_classifies_traces_at_once(self):
+        engine = spin.OrientationEngine()
+        samples = [self.gravity[orientation] for orientation in spin.ORIENTATIONS] + [[0.0, 0.0, 9.81], [0.0, 0.0, 0.0]]
+        self.assertEqual(engine.orientations(samples), spin.ORIENTATIONS + ["flat", None])
+
+    def test_mounting_matrix(self):
+        # A sensor turned a quarter turn from the screen reads the gravity of
+        # each orientation through the inverse, here the transpose, of its mounting.
+        mounting = spin.parse_mount_matrix("0, 1, 0; -1, 0, 0; 0, 0, 1")
+        engine = spin.OrientationEngine(mounting = mounting)
+        samples = [[sum(mounting[row][column] * self.gravity[orientation][row] for row in range(3))
+                    for column in range(3)]
+                   for orientation in spin.ORIENTATIONS]
+        self.assertEqual(engine.orientations(samples), spin.ORIENTATIONS)
+        self.assertNotEqual(spin.OrientationEngine().orientations(samples), spin.ORIENTATIONS)
+        self.assertRaises(ValueError, spin.parse_mount_matrix, "1, 0; 0, 1")
+
+
+class DeviceRegistryTest(unittest.TestCase):
+
+    touchscreen = "ELAN Touchscreen"
+    stylus = "Wacom ISDv4 EC Pen stylus"
+
+    def test_devices_are_indexed_by_role(self):
+        backend = spin.FakeBackend([self.touchscreen, "AT Translated Set 2 keyboard"])
+        registry = spin.DeviceRegistry(backend, spin.DEVICE_KEYPHRASES)
+        self.assertTrue(registry.has("touchscreen"))
+        self.assertFalse(registry.has("stylus"))
+        self.assertEqual(registry.names(), {"touchscreen": self.touchscreen})
+        backend.devices = set([self.stylus])
+        self.assertTrue(registry.is_present(self.stylus))
+        self.assertFalse(registry.is_present(self.touchscreen))
+        self.assertEqual(registry.devices("touchscreen"), [])
+
+    def test_watched_registry_never_asks_the_backend(self):
+        backend = spin.FakeBackend([self.stylus])
+        registry = spin.DeviceRegistry(backend, spin.DEVICE_KEYPHRASES)
+        registry.refresh()
+        registry.watching = True
+        backend.devices = set()
+        self.assertTrue(registry.is_present(self.stylus))
+        self.assertEqual(registry.devices("stylus"), [self.stylus])
+        # As a hotplug event would.
+        registry.refresh()
+        self.assertFalse(registry.is_present(self.stylus))
+
+
+class FakeAcpidTest(TemporaryDirectoryTestCase):
+
+    def test_replays_events_to_a_client(self):
+        acpid = spin.FakeAcpid(os.path.join(self.directory, "acpid.socket"))
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(acpid.path)
+            self.assertTrue(acpid.wait_for_client())
+            events = sorted(spin.ACPI_ACTIONS)
+            capture = os.path.join(self.directory, "acpi.log")
+            with open(capture, "w") as lines:
+                for event in events:
+                    lines.write(" ".join(event) + "\n")
+            acpid.replay(capture)
+            client.settimeout(5.0)
+            parser = spin.AcpiEventParser()
+            received = []
+            while len(received) < len(events):
+                data = client.recv(4096)
+                self.assertTrue(data)
+                received += parser.feed(data)
+            self.assertEqual(received, events)
+            self.assertEqual([spin.ACPI_ACTIONS[event][0] for event in received],
+                             [spin.ACPI_ACTIONS[event][0] for event in events])
+        finally:
+            client.close()
+            acpid.close()
+
+    def test_parser_joins_split_reads(self):
+        parser = spin.AcpiEventParser()
+        self.assertEqual(parser.feed("ibm/hotkey LEN0068:00 0000"), [])
+        self.assertEqual(parser.feed("0080 00006020\n video/tabletmode TBLT 0000008A 00000001\n"),
+                         [("ibm/hotkey", "LEN0068:00", "00000080", "00006020"),
+                          ("", "video/tabletmode", "TBLT", "0000008A 00000001")])
+
+
+class AcpiActionsTest(TemporaryDirectoryTestCase):
+
+    def test_settings_extend_the_table(self):
+        path = os.path.join(self.directory, "acpi.conf")
+        with open(path, "w") as settings:
+            json.dump({"video/tabletmode TBLT 0000008A 00000001": "tablet",
+                       "ibm/hotkey LEN0068:00 00000080 000060c0": ["laptop", 1.0],
+                       "button/lid LID close": "tabletmode"}, settings)
+        actions = spin.load_acpi_actions(path)
+        self.assertEqual(actions[("video/tabletmode", "TBLT", "0000008A", "00000001")], ("tablet", 0.0))
+        self.assertEqual(actions[("ibm/hotkey", "LEN0068:00", "00000080", "000060c0")], ("laptop", 1.0))
+        # An unknown mode would stop the daemon when its key is pressed.
+        self.assertNotIn(("button/lid", "LID", "close", ""), actions)
+        self.assertEqual(len(actions), len(spin.ACPI_ACTIONS) + 1)
+
+    def test_unreadable_settings_keep_the_table(self):
+        path = os.path.join(self.directory, "acpi.conf")
+        with open(path, "w") as settings:
+            settings.write('{"button/lid LID close": "tablet",}')
+        self.assertEqual(spin.load_acpi_actions(path), spin.ACPI_ACTIONS)
+
+
+class CalibrationStoreTest(TemporaryDirectoryTestCase):
+
+    stylus = "Wacom Pen stylus"
+    eraser = "Wacom Pen eraser"
+
+    def setUp(self):
+        super(CalibrationStoreTest, self).setUp()
+        self.path = os.path.join(self.directory, "spin", "spin.conf")
+        self.backend = spin.FakeBackend(area = (0, 0, 1000, 1000))
+
+    def read(self):
+        with open(self.path) as settings:
+            return json.load(settings)
+
+    def write(self, text):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "w") as settings:
+            settings.write(text)
+
+    def test_starts_from_the_current_area(self):
+        store = spin.CalibrationStore(self.stylus, self.backend, self.path)
+        self.assertEqual(store.area("left"), [0, 0, 1000, 1000])
+        # The eraser shares the calibration of the stylus.
+        self.assertEqual(store.area("left", self.eraser), [0, 0, 1000, 1000])
+        self.assertEqual(self.read()["calibrations"][self.stylus]["*"]["right"], [0, 0, 1000, 1000])
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["spin.conf"])
+
+    def test_changes_are_written_together(self):
+        store = spin.CalibrationStore(self.stylus, self.backend, self.path, delay = 60.0)
+        store.set([1, 2, 3, 4], "left")
+        store.set([5, 6, 7, 8], "right", output = "HDMI1")
+        self.assertFalse(os.path.exists(self.path))
+        store.flush()
+        self.assertIsNone(store.timer)
+        calibrations = self.read()["calibrations"][self.stylus]
+        self.assertEqual(calibrations["*"]["left"], [1, 2, 3, 4])
+        self.assertEqual(calibrations["HDMI1"]["right"], [5, 6, 7, 8])
+        self.assertEqual(store.area("right", output = "HDMI1"), [5, 6, 7, 8])
+        self.assertEqual(store.area("left", output = "eDP1"), [1, 2, 3, 4])
+
+    def test_old_settings_are_migrated(self):
+        self.write(json.dumps(dict((orientation, [index, 0, 100, 100])
+                                   for index, orientation in enumerate(spin.ORIENTATIONS))))
+        store = spin.CalibrationStore(self.stylus, self.backend, self.path)
+        self.assertEqual(store.area("inverted"), [spin.ORIENTATIONS.index("inverted"), 0, 100, 100])
+        settings = self.read()
+        self.assertEqual(settings["version"], 2)
+        self.assertEqual(sorted(settings["calibrations"][self.stylus]["*"]), sorted(spin.ORIENTATIONS))
+
+    def test_reloads_the_file_when_it_changes(self):
+        store = spin.CalibrationStore(self.stylus, self.backend, self.path)
+        store.set([1, 2, 3, 4], "left")
+        settings = self.read()
+        settings["calibrations"][self.stylus]["*"]["left"] = [9, 9, 99, 99]
+        self.write(json.dumps(settings))
+        os.utime(self.path, (0, 0))
+        self.assertEqual(store.area("left"), [9, 9, 99, 99])
+
+    def test_unreadable_settings_are_never_written_over(self):
+        text = '{"version": 2, "calibrations": {"%s": {"*": {"left": [1, 2, 3, 4],}}}}' % self.stylus
+        self.write(text)
+        store = spin.CalibrationStore(self.stylus, self.backend, self.path)
+        self.assertEqual(store.area("left"), [0, 0, 1000, 1000])
+        store.set([5, 6, 7, 8], "right")
+        self.assertEqual(store.area("right"), [5, 6, 7, 8])
+        with open(self.path) as settings:
+            self.assertEqual(settings.read(), text)
+        # Once fixed, the file is read again.
+        self.write(text.replace("],}", "]}"))
+        os.utime(self.path, (0, 0))
+        self.assertEqual(store.area("left"), [1, 2, 3, 4])
+
+
+class ControlServerTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super(ControlServerTest, self).setUp()
+        self.watched = {}
+        self.handled = []
+        self.server = spin.ControlServer(os.path.join(self.directory, "control.socket"),
+                                         self.watch, self.unwatch, self.handle, backlog = 4)
+
+    def tearDown(self):
+        self.server.shutdown()
+        super(ControlServerTest, self).tearDown()
+
+    def watch(self, fd, callback, write = False):
+        self.watched[(fd, write)] = callback
+
+    def unwatch(self, fd, write = False):
+        self.watched.pop((fd, write), None)
+
+    def handle(self, command, received):
+        if command not in ["toggle", "status"]:
+            raise ValueError("Unknown command {0}".format(command))
+        self.handled.append(command)
+        if command == "status":
+            return {"state": {"mode": "laptop"}}
+
+    def wakeup(self):
+        ''' Call every read callback, as an event loop would when all are readable '''
+        for key, callback in list(self.watched.items()):
+            if not key[1] and key in self.watched:
+                callback()
+
+    def connect(self):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.server.path)
+        client.settimeout(5.0)
+        self.wakeup()
+        return client
+
+    def receive(self, client, count = 1):
+        data = ""
+        while data.count("\n") < count:
+            received = client.recv(4096)
+            self.assertTrue(received)
+            data += received
+        return [json.loads(line) for line in data.splitlines()]
+
+    def test_batched_request(self):
+        client = self.connect()
+        try:
+            client.sendall(json.dumps({"version": 1, "id": 3, "commands": ["toggle", "status", "tabletmode"]}) + "\n")
+            self.wakeup()
+            response, = self.receive(client)
+            self.assertEqual(response["id"], 3)
+            self.assertFalse(response["ok"])
+            self.assertEqual([result["ok"] for result in response["results"]], [True, True, False])
+            self.assertEqual(response["results"][1]["state"], {"mode": "laptop"})
+            self.assertIn("tabletmode", response["results"][2]["error"])
+            self.assertEqual(self.handled, ["toggle", "status"])
+        finally:
+            client.close()
+
+    def test_bare_commands_and_bad_requests(self):
+        client = self.connect()
+        try:
+            # Requests split across reads are only run once complete.
+            client.sendall("tog")
+            self.wakeup()
+            client.sendall('gle\n{"commands": "toggle"}\n{"version": 99, "commands": ["toggle"]}\n')
+            self.wakeup()
+            bare, listless, future = self.receive(client, 3)
+            self.assertTrue(bare["ok"])
+            self.assertEqual(bare["results"][0]["command"], "toggle")
+            self.assertFalse(listless["ok"])
+            self.assertFalse(future["ok"])
+            self.assertEqual(self.handled, ["toggle"])
+        finally:
+            client.close()
+
+    def test_client_shutting_down_after_its_request(self):
+        client = self.connect()
+        try:
+            # As "echo request | socat - UNIX-CONNECT:..." does.
+            client.sendall('{"id": 1, "commands": ["toggle"]}\n{"id": 2, "commands": ["status"]}')
+            client.shutdown(socket.SHUT_WR)
+            self.wakeup()
+            self.assertEqual(self.handled, ["toggle", "status"])
+            self.assertEqual([response["id"] for response in self.receive(client, 2)], [1, 2])
+            self.assertEqual(client.recv(4096), "")
+            self.assertEqual(self.server.connections, {})
+            self.assertEqual(self.watched.keys(), [(self.server.server.fileno(), False)])
+        finally:
+            client.close()
+
+    def test_subscribers_get_published_events(self):
+        client = self.connect()
+        try:
+            client.sendall("subscribe\n")
+            self.wakeup()
+            self.assertTrue(self.receive(client)[0]["ok"])
+            self.server.publish("mode", "tablet", 10.0)
+            event, = self.receive(client)
+            self.assertEqual((event["event"], event["value"], event["time"]), ("mode", "tablet", 10.0))
+        finally:
+            client.close()
+
+    def test_waiting_events_are_coalesced_and_dropped(self):
+        blocked = BlockedSocket()
+        connection = spin.ControlConnection(blocked)
+        connection.subscribed = True
+        self.server.connections[connection.fd] = connection
+        # The first event is serialised and waits for the socket to drain.
+        self.server.publish("mode", "tablet")
+        self.assertTrue(connection.writing)
+        for orientation in ["left", "inverted", "right"]:
+            self.server.publish("orientation", orientation)
+        self.assertEqual([(event["event"], event["value"]) for event in connection.events],
+                         [("orientation", "right")])
+        # Events of other kinds queue up, until the backlog of 4 drops the oldest.
+        for count in range(4):
+            self.server.publish("calibrated", count)
+        self.assertEqual(connection.dropped, 1)
+        blocked.blocked = False
+        self.server.flush(connection)
+        events = [json.loads(line) for line in blocked.sent.splitlines()]
+        self.assertEqual([(event["event"], event["value"]) for event in events],
+                         [("mode", "tablet")] + [("calibrated", count) for count in range(4)])
+        self.assertEqual([event.get("dropped") for event in events], [None, 1, None, None, None])
+        self.assertFalse(connection.writing)
+
+
+class BlockedSocket():
+    ''' A control client socket that takes no output until unblocked '''
+
+    def __init__(self):
+        self.blocked = True
+        self.sent = ""
+
+    def fileno(self):
+        return -1
+
+    def send(self, data):
+        if self.blocked:
+            raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        self.sent += data
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class QueuedWorker():
+    ''' An action worker whose jobs run only when the test says so '''
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, description, actions, requested = None):
+        self.jobs.append(actions)
+
+    def run(self):
+        jobs, self.jobs = self.jobs, []
+        for actions in jobs:
+            for action in actions:
+                action()
+
+
+class StateReconcilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = QueuedWorker()
+        self.executor = spin.ActionExecutor(workers = 2)
+        self.transitions = []
+        self.failing = set()
+        self.reconciler = spin.StateReconciler(self.worker, self.transition, self.executor, debounce = 0.0,
+                                               mode = "laptop", orientation = "normal")
+
+    def tearDown(self):
+        self.executor.stop()
+        # Also let the cancelled step timers end, before the interpreter does.
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join(1.0)
+
+    def transition(self, current, target):
+        self.transitions.append((dict(current), dict(target)))
+        graph = spin.ActionGraph()
+        for part in sorted(target):
+            if target[part] != current[part]:
+                graph.add(part, lambda part = part: self.apply(part), state = part)
+        return graph
+
+    def apply(self, part):
+        if part in self.failing:
+            raise spin.CommandError("Failed to apply {0}".format(part))
+
+    def test_burst_applies_only_the_latest_state(self):
+        for orientation in ["left", "inverted", "right"]:
+            self.reconciler.request(orientation = orientation)
+        self.reconciler.request(mode = "tablet")
+        self.assertEqual(len(self.worker.jobs), 1)
+        self.worker.run()
+        self.assertEqual(self.transitions, [({"mode": "laptop", "orientation": "normal"},
+                                             {"mode": "tablet", "orientation": "right"})])
+        self.assertEqual(self.reconciler.applied, {"mode": "tablet", "orientation": "right"})
+        self.assertEqual(sorted(self.reconciler.results), ["mode", "orientation"])
+
+    def test_requests_ending_where_they_started_do_nothing(self):
+        self.reconciler.request(orientation = "left")
+        self.reconciler.request(orientation = "normal")
+        self.worker.run()
+        self.reconciler.request(mode = "laptop")
+        self.worker.run()
+        self.assertEqual(self.transitions, [])
+
+    def test_failed_parts_are_tried_again(self):
+        self.failing.add("orientation")
+        self.reconciler.request(mode = "tablet", orientation = "left")
+        self.worker.run()
+        self.assertEqual(self.reconciler.results["orientation"]["status"], "failed")
+        self.assertEqual(self.reconciler.applied, {"mode": "tablet", "orientation": "normal"})
+        self.failing.clear()
+        self.reconciler.request(orientation = "left")
+        self.worker.run()
+        self.assertEqual(self.transitions[-1], ({"mode": "tablet", "orientation": "normal"},
+                                                {"mode": "tablet", "orientation": "left"}))
+        self.assertEqual(self.reconciler.applied, {"mode": "tablet", "orientation": "left"})
+
+
+class ActionExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = spin.ActionExecutor(workers = 2)
+
+    def tearDown(self):
+        self.executor.stop()
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join(1.0)
+
+    def test_independent_steps_run_at_once(self):
+        both = threading.Event()
+        started = []
+        def step(name):
+            started.append(name)
+            if len(started) == 2:
+                both.set()
+            return both.wait(2.0)
+        graph = spin.ActionGraph()
+        graph.add("pointer", lambda: step("pointer"))
+        graph.add("display", lambda: step("display"))
+        graph.add("touchscreen", lambda: "touched", after = ["pointer", "display"])
+        outcomes = self.executor.run(graph)
+        self.assertEqual(dict((name, outcome["status"]) for name, outcome in outcomes.items()),
+                         {"pointer": "ok", "display": "ok", "touchscreen": "ok"})
+        self.assertTrue(outcomes["display"]["result"])
+        self.assertEqual(outcomes["touchscreen"]["result"], "touched")
+
+    def test_steps_after_a_failure_or_timeout_are_skipped(self):
+        def fail():
+            raise spin.CommandError("xrandr exited with status 1")
+        released = threading.Event()
+        graph = spin.ActionGraph()
+        graph.add("display", fail)
+        graph.add("touchscreen matrix", lambda: None, after = "display")
+        graph.add("stylus area", lambda: None, after = "touchscreen matrix")
+        graph.add("pointer", lambda: released.wait(2.0), timeout = 0.05)
+        graph.add("notify", lambda: None, after = "pointer")
+        graph.add("touchpad", lambda: None)
+        outcomes = self.executor.run(graph)
+        released.set()
+        self.assertEqual(dict((name, outcome["status"]) for name, outcome in outcomes.items()),
+                         {"display": "failed", "touchscreen matrix": "skipped", "stylus area": "skipped",
+                          "pointer": "timeout", "notify": "skipped", "touchpad": "ok"})
+        self.assertIn("status 1", outcomes["display"]["result"])
+
+    def test_steps_only_come_after_known_steps(self):
+        graph = spin.ActionGraph()
+        graph.add("display", lambda: None)
+        self.assertRaises(ValueError, graph.add, "touchscreen", lambda: None, after = "dispaly")
+        self.assertRaises(ValueError, graph.add, "display", lambda: None)
+
+
+if __name__ == "__main__":
+    unittest.main()